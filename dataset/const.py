@@ -93,6 +93,11 @@ CB_A_PREPREP_QUERY = """
     from data
     """
 
+# topics whose depth 2 chunks are reshaped (and downcast) before DEPTH_2_TO_1_QUERY
+DEPTH_2_PREP_QUERY: Dict[str, str] = {
+    'credit_bureau_a': CB_A_PREPREP_QUERY,
+}
+
 DEPTH_2_TO_1_QUERY: Dict[str, str] = {
     'applprev': """
             SELECT case_id, num_group1
@@ -1,16 +1,28 @@
+import json
 import os
-from typing import Union
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 import pandas as pd
 import polars as pl
 from pathlib import Path
 from argparse import Namespace
 from dataclasses import dataclass
+import pyarrow as pa
+import pyarrow.compute as pc
 from pyarrow.parquet import ParquetFile
+from dataset.feature.util import apply_dtype_plan
+from dataset.const import KEY_COL
 
 
 BASE_PATH = Path(os.getcwd())
 DATA_PATH = BASE_PATH / "data" / "home-credit-credit-risk-model-stability"
 os.makedirs(DATA_PATH, exist_ok=True)
+# prep files are sorted by case_id in row groups of this many rows
+PREP_ROW_GROUP_SIZE = 100_000
+PREP_SORT_COLS = [*KEY_COL, 'num_group1', 'num_group2']
+# storage formats of prep files and feature outputs, by file suffix
+PREP_FORMATS = {"parquet": ".parquet", "ipc": ".arrow"}
 
 POSTFIXES = {
     "P": "Transform DPD (Days Past Due)",
@@ -125,6 +137,47 @@ class ColInfo:
             return f"{self.name}: {result_description}"
 
 
+def read_ipc_mmap(file_path: Path, columns: list[str] = None) -> pl.DataFrame:
+    """
+    Zero copy read of an uncompressed Arrow IPC file through a memory map.
+    Pages are loaded when touched and stay in the OS page cache across reads.
+    """
+    table = pa.ipc.open_file(pa.memory_map(str(file_path), 'r')).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return pl.from_arrow(table, rechunk=False)
+
+
+def read_frame(file_path: Path, columns: list[str] = None) -> pl.DataFrame:
+    if Path(file_path).suffix == PREP_FORMATS["ipc"]:
+        return read_ipc_mmap(file_path, columns)
+    return pl.read_parquet(file_path, columns=columns)
+
+
+def write_frame(
+    data: Union[pl.DataFrame, pl.LazyFrame], file_path: Path, row_group_size: int = None
+):
+    """
+    Write data as parquet, or as uncompressed Arrow IPC (memory mappable) for
+    an .arrow path. row_group_size sets the record batch size of IPC files.
+    """
+    lazy = isinstance(data, pl.LazyFrame)
+    if Path(file_path).suffix == PREP_FORMATS["ipc"]:
+        write = data.sink_ipc if lazy else data.write_ipc
+        write(file_path, compression='uncompressed', record_batch_size=row_group_size)
+    else:
+        write = data.sink_parquet if lazy else data.write_parquet
+        write(file_path, statistics=True, row_group_size=row_group_size)
+
+
+def iter_record_batches(file_path: Path, batch_size: int):
+    if Path(file_path).suffix == PREP_FORMATS["ipc"]:
+        table = pa.ipc.open_file(pa.memory_map(str(file_path), 'r')).read_all()
+        yield from table.to_batches(max_chunksize=batch_size)
+    else:
+        yield from ParquetFile(file_path).iter_batches(batch_size=batch_size)
+
+
 class RawReader:
     def __init__(self, return_type: str = 'pandas', format: str = "parquet") -> None:
         self.return_type = return_type
@@ -142,15 +195,38 @@ class RawReader:
         elif format == "csv" and return_type == 'polars':
             self.reader = pl.read_csv
             self.column_getter = self._get_csv_columns
+        elif format == "parquet" and return_type == 'lazy':
+            self.reader = pl.scan_parquet
+            self.column_getter = self._get_parquet_columns
+        elif format == "csv" and return_type == 'lazy':
+            self.reader = pl.scan_csv
+            self.column_getter = self._get_csv_columns
+        elif format == "ipc" and return_type == 'pandas':
+            self.reader = self._read_ipc_pandas
+            self.column_getter = self._get_ipc_columns
+        elif format == "ipc" and return_type == 'polars':
+            self.reader = read_ipc_mmap
+            self.column_getter = self._get_ipc_columns
+        elif format == "ipc" and return_type == 'lazy':
+            self.reader = lambda file_path: read_ipc_mmap(file_path).lazy()
+            self.column_getter = self._get_ipc_columns
         else:
             raise ValueError(
-                "format should be either 'parquet' or 'csv'"
-                "and return_type should be 'pandas' or 'polars'."
+                "format should be either 'parquet', 'csv' or 'ipc'"
+                "and return_type should be 'pandas', 'polars' or 'lazy'."
                 f"Not {format}, {return_type}."
             )
 
-    def read(self, file_path: Path) -> Union[pd.DataFrame, pl.DataFrame]:
-        return self.reader(file_path)
+    def read(
+        self, file_path: Path, columns: list[str] = None
+    ) -> Union[pd.DataFrame, pl.DataFrame, pl.LazyFrame]:
+        if columns is None:
+            return self.reader(file_path)
+        if self.return_type == 'lazy':
+            return self.reader(file_path).select(columns)
+        if self.return_type == 'pandas' and self.format == 'csv':
+            return self.reader(file_path, usecols=columns)
+        return self.reader(file_path, columns=columns)
 
     def columns(self, file_path: Path) -> list[ColInfo]:
         return [ColInfo(c) for c in self.column_getter(file_path)]
@@ -158,14 +234,143 @@ class RawReader:
     def _get_csv_columns(self, file_path: Path) -> list[ColInfo]:
         if self.return_type == 'pandas':
             return [c for c in pd.read_csv(file_path, nrows=0).columns]
-        elif self.return_type == 'polars':
+        elif self.return_type in ('polars', 'lazy'):
             return [c for c in pl.read_csv(file_path, n_rows=0).columns]
 
     def _get_parquet_columns(self, file_path: Path) -> list[ColInfo]:
-        return [c for c in ParquetFile(file_path).columns]
+        return [c for c in ParquetFile(file_path).schema_arrow.names]
 
-    def __call__(self, file_path) -> Union[pd.DataFrame, pl.DataFrame]:
-        return self.read(file_path)
+    def _get_ipc_columns(self, file_path: Path) -> list[ColInfo]:
+        return [c for c in pa.ipc.open_file(pa.memory_map(str(file_path), 'r')).schema.names]
+
+    @staticmethod
+    def _read_ipc_pandas(file_path: Path, columns: list[str] = None) -> pd.DataFrame:
+        table = pa.ipc.open_file(pa.memory_map(str(file_path), 'r')).read_all()
+        return (table.select(columns) if columns is not None else table).to_pandas()
+
+    def __call__(self, file_path, columns: list[str] = None) -> Union[pd.DataFrame, pl.DataFrame]:
+        return self.read(file_path, columns=columns)
+
+
+@dataclass
+class FileMetadata:
+    path: Path
+    size: int
+    mtime_ns: int
+    num_rows: int
+    schema: pa.Schema
+    # num_rows, num_bytes and case_id min / max of every row group (record batch for ipc)
+    row_groups: list[dict]
+
+    @property
+    def columns(self) -> list[str]:
+        return self.schema.names
+
+
+def read_file_metadata(path: Path) -> FileMetadata:
+    """
+    Footer metadata of a parquet or ipc file, without reading its data.
+    """
+    path = Path(path)
+    stat = os.stat(path)
+    row_groups = []
+    if path.suffix == PREP_FORMATS["ipc"]:
+        reader = pa.ipc.open_file(pa.memory_map(str(path), 'r'))
+        schema = reader.schema
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            keys = pc.min_max(batch.column(KEY_COL[0])) if KEY_COL[0] in schema.names else None
+            row_groups.append({
+                'num_rows': batch.num_rows,
+                'num_bytes': batch.nbytes,
+                'min': keys['min'].as_py() if keys is not None else None,
+                'max': keys['max'].as_py() if keys is not None else None,
+            })
+    elif path.suffix == ".parquet":
+        metadata = ParquetFile(path).metadata
+        schema = metadata.schema.to_arrow_schema()
+        key_index = schema.get_field_index(KEY_COL[0])
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            statistics = row_group.column(key_index).statistics if key_index >= 0 else None
+            has_range = statistics is not None and statistics.has_min_max
+            row_groups.append({
+                'num_rows': row_group.num_rows,
+                'num_bytes': row_group.total_byte_size,
+                'min': int(statistics.min) if has_range else None,
+                'max': int(statistics.max) if has_range else None,
+            })
+    else:
+        raise NotImplementedError(f"Metadata of {path.suffix} files is not supported.")
+    return FileMetadata(
+        path=path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        num_rows=sum(rg['num_rows'] for rg in row_groups),
+        schema=schema,
+        row_groups=row_groups,
+    )
+
+
+class FileCatalog:
+    """
+    Raw files of a data directory indexed by (type, name, depth).
+
+    Each type directory is listed once and kept until refresh(). File
+    metadata (row counts, schema, row group sizes and case_id ranges) is read
+    from the footer on first use and reused while the file's size and mtime
+    are unchanged, so planners can size batches and shards without opening
+    the files again.
+
+    Args:
+        file_dir_path (Path): directory holding the train / test directories.
+    """
+
+    def __init__(self, file_dir_path: Path):
+        self.file_dir_path = Path(file_dir_path)
+        self._by_name: dict[str, dict[str, list[RawFile]]] = {}
+        self._files: dict[str, list[RawFile]] = {}
+        self._metadata: dict[Path, FileMetadata] = {}
+
+    def _list(self, type_: str):
+        if type_ in self._files:
+            return
+        self._files[type_] = sorted([RawFile(f) for f in os.listdir(self.file_dir_path / type_)])
+        by_name: dict[str, list[RawFile]] = {}
+        for rf in self._files[type_]:
+            by_name.setdefault(rf.name, []).append(rf)
+        self._by_name[type_] = by_name
+
+    def files(self, type_: str = "train") -> list[RawFile]:
+        self._list(type_)
+        return list(self._files[type_])
+
+    def get(self, name: str, depth: int = None, type_: str = "train") -> list[RawFile]:
+        self._list(type_)
+        files = self._by_name[type_].get(name, [])
+        if depth is None:
+            return list(files)
+        return [f for f in files if f.depth == str(depth)]
+
+    def metadata(self, path: Path) -> FileMetadata:
+        path = Path(path)
+        cached = self._metadata.get(path)
+        if cached is not None:
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime_ns) == (cached.size, cached.mtime_ns):
+                return cached
+        self._metadata[path] = read_file_metadata(path)
+        return self._metadata[path]
+
+    def refresh(self, type_: str = None):
+        """
+        Forget the listing (of type_ or of every type) and all cached metadata.
+        """
+        types = list(self._files) if type_ is None else [type_]
+        for t in types:
+            self._files.pop(t, None)
+            self._by_name.pop(t, None)
+        self._metadata.clear()
 
 
 class RawInfo:
@@ -178,9 +383,13 @@ class RawInfo:
             self.config = Namespace(**{
                 "data_path": DATA_PATH,
                 "raw_format": "parquet",
+                "prep_format": "parquet",
             })
 
         self.format = self.config.raw_format
+        self.prep_format = getattr(self.config, "prep_format", "parquet")
+        if self.prep_format not in PREP_FORMATS:
+            raise ValueError(f"prep_format should be one of {list(PREP_FORMATS)}. Not {self.prep_format}.")
         self.data_dir_path = Path(self.config.data_path)
         self.file_dir_path = self.data_dir_path / f"{self.format}_files"
 
@@ -188,18 +397,15 @@ class RawInfo:
             raise FileNotFoundError(f"{self.file_dir_path} does not exist.")
 
         self.reader = RawReader(format=self.format)
+        self.catalog = FileCatalog(self.file_dir_path)
+        self.n_threads = getattr(self.config, "n_threads", None) or os.cpu_count()
+        self.ingest_stats: list[dict] = []
 
     def show_files(self, type_: str = "train") -> list[RawFile]:
-        return sorted([RawFile(f) for f in os.listdir(self.file_dir_path / type_)])
+        return self.catalog.files(type_)
 
     def get_files(self, filename: str, *, depth: int = None, type_: str = "train") -> list[RawFile]:
-        if depth is None:
-            return sorted([
-                f for f in self.show_files(type_) if f.name == filename])
-        else:
-            return sorted([
-                f for f in self.show_files(type_)
-                if f.name == filename and f.depth == str(depth)])
+        return self.catalog.get(filename, depth=depth, type_=type_)
 
     def get_depths_by_name(self, file_name: str, type_: str = "train") -> list[int]:
         return sorted(list(set([int(f.depth) for f in self.get_files(file_name, type_=type_)])))
@@ -207,6 +413,25 @@ class RawInfo:
     def get_files_by_depth(self, depth: int, type_: str = "train") -> list[RawFile]:
         return [f for f in self.show_files(type_) if f.depth == str(depth)]
 
+    def refresh_catalog(self, type_: str = None):
+        self.catalog.refresh(type_)
+
+    def get_metadata(
+        self, file_name: str, *, depth: int = None, type_: str = "train", stage: str = "raw"
+    ) -> list[FileMetadata]:
+        """
+        Cached footer metadata of the raw files (or the prep file) of a topic.
+        """
+        if stage == "prep":
+            return [self.catalog.metadata(self.get_prep_path(file_name, depth, type_))]
+        return [
+            self.catalog.metadata(rf.get_path(self.data_dir_path))
+            for rf in self.get_files(file_name, depth=depth, type_=type_)
+        ]
+
+    def num_rows(self, file_name: str, *, depth: int = None, type_: str = "train", stage: str = "raw") -> int:
+        return sum(m.num_rows for m in self.get_metadata(file_name, depth=depth, type_=type_, stage=stage))
+
     def read_raw(
         self,
         file_name: str,
@@ -214,27 +439,111 @@ class RawInfo:
         depth: int = None,
         reader: RawReader = None,
         type_: str = "train",
-        stage: str = "raw"
-    ) -> pd.DataFrame:
+        stage: str = "raw",
+        columns: list[str] = None,
+        dtypes: dict = None,
+    ) -> Union[pd.DataFrame, pl.DataFrame, pl.LazyFrame]:
         reader = self.reader if reader is None else reader
+        if dtypes is not None and reader.return_type == 'pandas':
+            raise ValueError("dtypes is a polars dtype plan, read with a 'polars' or 'lazy' reader to apply it.")
 
         raw_files = self.get_files(file_name, depth=depth, type_=type_)
         if len(raw_files) == 0:
             raise FileNotFoundError(f"{file_name} (depth: {depth}) does not exist in {type_} files.")
 
-        if reader.return_type == 'pandas' and stage == "raw":
-            raw_df = pd.concat([reader(rf.get_path(self.data_dir_path)) for rf in raw_files])
-        elif reader.return_type == 'polars' and stage == "raw":
-            raw_df = pl.concat(
-                [reader(rf.get_path(self.data_dir_path)) for rf in raw_files], how='vertical_relaxed'
-            )
+        if stage == "raw":
+            paths = [rf.get_path(self.data_dir_path) for rf in raw_files]
+            start_time = time.perf_counter()
+            raw_df = self._read_files(paths, reader, columns)
+            if reader.return_type != 'lazy':
+                self._record_ingest(file_name, depth, type_, paths, raw_df, time.perf_counter() - start_time)
         elif stage == "prep":
-            raw_df = reader(
-                DATA_PATH / 'parquet_preps' / type_ / f"{type_}_{file_name}_{depth}.parquet"
-            )
-
+            raw_df = self.prep_reader(reader)(self.get_prep_path(file_name, depth, type_), columns)
+            if (
+                reader.return_type != 'pandas'
+                and (columns is None or KEY_COL[0] in columns)
+                and self.has_prep_index(file_name, depth, type_)
+            ):
+                # indexed prep files are sorted by case_id, let joins on it merge
+                raw_df = raw_df.set_sorted(KEY_COL[0])
+
+        if dtypes is not None:
+            raw_df = apply_dtype_plan(raw_df, dtypes)
         return raw_df
 
+    def _read_files(
+        self, paths: list[Path], reader: RawReader, columns: list[str] = None
+    ) -> Union[pd.DataFrame, pl.DataFrame, pl.LazyFrame]:
+        """
+        Read and concatenate raw shards. Parquet shards are cast to the
+        reconciled schema and scanned as one lazy union, which polars reads in
+        parallel; pandas shards are read in a thread pool.
+        """
+        if reader.format != "parquet":
+            frames = [reader(path, columns) for path in paths]
+            if reader.return_type == 'pandas':
+                return pd.concat(frames)
+            return pl.concat(frames, how='vertical_relaxed')
+
+        if reader.return_type == 'pandas':
+            with ThreadPoolExecutor(max_workers=min(self.n_threads, len(paths))) as executor:
+                return pd.concat(list(executor.map(lambda path: reader(path, columns), paths)))
+
+        schemas = [pl.scan_parquet(path).collect_schema() for path in paths]
+        schema = self.reconcile_schema(schemas, columns)
+        frames = []
+        for path, file_schema in zip(paths, schemas):
+            frame = pl.scan_parquet(path).select(list(schema))
+            casts = {col: dtype for col, dtype in schema.items() if file_schema[col] != dtype}
+            frames.append(frame.cast(casts) if len(casts) > 0 else frame)
+        raw_df = pl.concat(frames, how='vertical', parallel=True)
+        return raw_df if reader.return_type == 'lazy' else raw_df.collect()
+
+    @staticmethod
+    def reconcile_schema(schemas: list[pl.Schema], columns: list[str] = None) -> pl.Schema:
+        """
+        Common schema of shards from their parquet footers, with the supertypes
+        pl.concat(how='vertical_relaxed') would pick.
+        """
+        empties = [pl.DataFrame(schema=schema) for schema in schemas]
+        if columns is not None:
+            empties = [empty.select(columns) for empty in empties]
+        return pl.concat(empties, how='vertical_relaxed').schema
+
+    def _record_ingest(
+        self,
+        file_name: str,
+        depth: int,
+        type_: str,
+        paths: list[Path],
+        data: Union[pd.DataFrame, pl.DataFrame],
+        seconds: float,
+    ):
+        self.ingest_stats.append({
+            'name': file_name,
+            'depth': depth,
+            'type': type_,
+            'files': len(paths),
+            'rows': len(data),
+            'bytes': sum(os.path.getsize(path) for path in paths),
+            'seconds': seconds,
+        })
+
+    def ingest_report(self) -> str:
+        """
+        Throughput of every eager raw read so far, one line per topic.
+        """
+        lines = []
+        for stats in self.ingest_stats:
+            seconds = max(stats['seconds'], 1e-9)
+            lines.append(
+                f"[*] Ingested {stats['type']} {stats['name']} (depth: {stats['depth']}): "
+                f"{stats['files']} files, {stats['rows']} rows, {stats['bytes'] / 1024 ** 2:.2f} MB "
+                f"in {stats['seconds']:.4f} sec, {stats['bytes'] / 1024 ** 2 / seconds:.2f} MB/s, "
+                f"{stats['rows'] / seconds:.0f} rows/s"
+            )
+        return '\n'.join(lines)
+
     def read_raw_iter(
         self,
         file_name: str,
@@ -242,8 +551,16 @@ class RawInfo:
         depth: int = None,
         reader: RawReader = None,
         type_: str = "train",
+        stage: str = "raw",
+        batch_size: int = None,
     ):
+        """
+        Yield the raw files (or the prep file) one by one, or in record
+        batches of batch_size rows so that only one batch is in memory.
+        """
         reader = self.reader if reader is None else reader
+        if dtypes is not None and reader.return_type == 'pandas':
+            raise ValueError("dtypes is a polars dtype plan, read with a 'polars' or 'lazy' reader to apply it.")
 
         raw_files = self.get_files(file_name, depth=depth, type_=type_)
         if len(raw_files) == 0:
@@ -251,23 +568,210 @@ class RawInfo:
                 f"{file_name} (depth: {depth}) does not exist in {type_} files."
             )
 
-        if reader.return_type == 'pandas':
-            for rf in raw_files:
-                yield reader(rf.get_path(self.data_dir_path))
-        elif reader.return_type == 'polars':
-            for rf in raw_files:
-                yield reader(rf.get_path(self.data_dir_path))
-
-    def save_as_prep(self, data: pl.DataFrame, file_name: str, depth: int, type_: str = "train"):
+        if stage == "prep":
+            paths = [self.get_prep_path(file_name, depth, type_)]
+            reader = self.prep_reader(reader)
+        else:
+            paths = [rf.get_path(self.data_dir_path) for rf in raw_files]
+
+        for path in paths:
+            if batch_size is None:
+                yield reader(path)
+                continue
+            if reader.format == "csv":
+                raise NotImplementedError("batch_size is not supported for csv files.")
+            for batch in iter_record_batches(path, batch_size):
+                if reader.return_type == 'pandas':
+                    yield batch.to_pandas()
+                elif reader.return_type == 'polars':
+                    yield pl.from_arrow(batch)
+                else:
+                    yield pl.from_arrow(batch).lazy()
+
+    def prep_reader(self, reader: RawReader) -> RawReader:
+        """
+        reader for the prep files, keeping the return type of reader.
+        """
+        if reader.format == self.prep_format:
+            return reader
+        return RawReader(reader.return_type, self.prep_format)
+
+    def get_prep_path(self, file_name: str, depth: int, type_: str = "train") -> Path:
+        suffix = PREP_FORMATS[self.prep_format]
+        return DATA_PATH / 'parquet_preps' / type_ / f"{type_}_{file_name}_{depth}{suffix}"
+
+    @staticmethod
+    def get_dtype_plan_path(file_name: str, depth: int) -> Path:
+        return DATA_PATH / 'parquet_preps' / 'dtypes' / f"{file_name}_{depth}.json"
+
+    def get_prep_index_path(self, file_name: str, depth: int, type_: str = "train") -> Path:
+        # parquet keeps the unsuffixed name of the index written before ipc existed
+        suffix = "" if self.prep_format == "parquet" else PREP_FORMATS[self.prep_format]
+        return DATA_PATH / 'parquet_preps' / type_ / f"{type_}_{file_name}_{depth}{suffix}.index.json"
+
+    def save_as_prep(
+        self,
+        data: Union[pl.DataFrame, pl.LazyFrame],
+        file_name: str,
+        depth: int,
+        type_: str = "train",
+        row_group_size: int = PREP_ROW_GROUP_SIZE,
+    ):
+        """
+        Write a prep file sorted by case_id with row group statistics (record
+        batches for ipc), and a sidecar index of the case_id range of every
+        row group, with the size and mtime of the file it describes.
+        """
         if type_ not in self.VALID_TYPES:
             raise ValueError(f"type_ should be one of {self.VALID_TYPES}. Not {type_}.")
         if str(depth) not in self.VALID_DEPTHS:
             raise ValueError(f"depth should be one of {self.VALID_DEPTHS}. Not {depth}.")
 
         os.makedirs(DATA_PATH / 'parquet_preps' / type_, exist_ok=True)
-        data.write_parquet(
-            DATA_PATH / 'parquet_preps' / type_ / f"{type_}_{file_name}_{depth}.parquet"
+        path = self.get_prep_path(file_name, depth, type_)
+        schema = data.collect_schema() if isinstance(data, pl.LazyFrame) else data.schema
+        data = data.sort([c for c in PREP_SORT_COLS if c in schema])
+        write_frame(data, path, row_group_size)
+
+        stat = os.stat(path)
+        with open(self.get_prep_index_path(file_name, depth, type_), 'w') as f:
+            json.dump(
+                {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'row_groups': self.build_prep_index(path)},
+                f,
+            )
+
+    @staticmethod
+    def build_prep_index(path: Path) -> list[dict]:
+        """
+        case_id min / max and row count of each row group, from the parquet
+        footer, or of each record batch of an ipc file.
+        """
+        if Path(path).suffix == PREP_FORMATS["ipc"]:
+            reader = pa.ipc.open_file(pa.memory_map(str(path), 'r'))
+            index = []
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if batch.num_rows == 0:
+                    continue
+                min_max = pc.min_max(batch.column(KEY_COL[0]))
+                index.append({
+                    'row_group': i,
+                    'min': min_max['min'].as_py(),
+                    'max': min_max['max'].as_py(),
+                    'num_rows': batch.num_rows,
+                })
+            return index
+
+        metadata = ParquetFile(path).metadata
+        key_index = metadata.schema.to_arrow_schema().get_field_index(KEY_COL[0])
+        index = []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            statistics = row_group.column(key_index).statistics
+            index.append({
+                'row_group': i,
+                'min': int(statistics.min),
+                'max': int(statistics.max),
+                'num_rows': row_group.num_rows,
+            })
+        return index
+
+    def _load_prep_index(self, file_name: str, depth: int, type_: str = "train") -> Optional[list[dict]]:
+        """
+        The sidecar index if it describes the prep file as it is now, None if
+        it is missing or stale: the file must have the size and mtime it had
+        when indexed, and its row groups the row counts and case_id ranges of
+        the index (from the footer cached in the catalog). Indexes written
+        before the size and mtime were recorded are only checked on the footer.
+        """
+        index_path = self.get_prep_index_path(file_name, depth, type_)
+        path = self.get_prep_path(file_name, depth, type_)
+        if not index_path.exists() or not path.exists():
+            return None
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        metadata = self.catalog.metadata(path)
+        if isinstance(index, dict):
+            if (index['size'], index['mtime_ns']) != (metadata.size, metadata.mtime_ns):
+                return None
+            index = index['row_groups']
+        # the ipc index skips empty record batches
+        footer = [rg for rg in metadata.row_groups if rg['num_rows'] > 0]
+        matches = len(index) == len(footer) and all(
+            (rg['num_rows'], rg['min'], rg['max']) == (other['num_rows'], other['min'], other['max'])
+            for rg, other in zip(index, footer)
         )
+        return index if matches else None
+
+    def has_prep_index(self, file_name: str, depth: int, type_: str = "train") -> bool:
+        return self._load_prep_index(file_name, depth, type_) is not None
+
+    def read_prep_index(self, file_name: str, depth: int, type_: str = "train") -> list[dict]:
+        index_path = self.get_prep_index_path(file_name, depth, type_)
+        if not index_path.exists():
+            raise FileNotFoundError(f"{index_path} does not exist. Save the prep file again.")
+        index = self._load_prep_index(file_name, depth, type_)
+        if index is None:
+            raise ValueError(f"{index_path} does not match its prep file. Save the prep file again.")
+        return index
+
+    def read_prep_range(
+        self,
+        file_name: str,
+        depth: int,
+        low: int = None,
+        high: int = None,
+        type_: str = "train",
+        columns: list[str] = None,
+    ) -> pl.DataFrame:
+        """
+        Read the rows with low <= case_id < high, touching only the row groups
+        whose case_id range overlaps it.
+        """
+        index = self.read_prep_index(file_name, depth, type_)
+        row_groups = [
+            rg['row_group'] for rg in index
+            if (low is None or rg['max'] >= low) and (high is None or rg['min'] < high)
+        ]
+        path = self.get_prep_path(file_name, depth, type_)
+        if columns is not None:
+            columns = list(dict.fromkeys([*KEY_COL, *columns]))
+        if self.prep_format == "ipc":
+            reader = pa.ipc.open_file(pa.memory_map(str(path), 'r'))
+            table = pa.Table.from_batches([reader.get_batch(i) for i in row_groups], schema=reader.schema)
+            data = pl.from_arrow(table.select(columns) if columns is not None else table, rechunk=False)
+        else:
+            data = pl.from_arrow(ParquetFile(path).read_row_groups(row_groups, columns=columns))
+        if low is not None:
+            data = data.filter(pl.col(KEY_COL[0]) >= low)
+        if high is not None:
+            data = data.filter(pl.col(KEY_COL[0]) < high)
+        return data.set_sorted(KEY_COL[0])
+
+    def read_prep_case(
+        self, file_name: str, depth: int, case_id: int, type_: str = "train", columns: list[str] = None
+    ) -> pl.DataFrame:
+        return self.read_prep_range(file_name, depth, case_id, case_id + 1, type_, columns)
+
+    def get_prep_ranges(
+        self, file_name: str, depth: int, n_ranges: int, type_: str = "train"
+    ) -> list[tuple[int, int]]:
+        """
+        Split the case_id domain into about n_ranges [low, high) ranges aligned
+        to row groups, so each range can be read independently.
+        """
+        index = self.read_prep_index(file_name, depth, type_)
+        if len(index) == 0:
+            return []
+        step = max(1, -(-len(index) // n_ranges))
+        bounds = [index[i]['min'] for i in range(0, len(index), step)]
+        # ranges are half open on case_id, so a case spanning two row groups
+        # still lands in exactly one of them
+        bounds = sorted(set(bounds))
+        return [
+            (low, high)
+            for low, high in zip(bounds, [*bounds[1:], index[-1]['max'] + 1])
+        ]
 
 if __name__ == "__main__":
     raw_info = RawInfo(
@@ -0,0 +1,267 @@
+import math
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple, Union
+import pandas as pd
+import polars as pl
+
+from dataset.datainfo import RawInfo, RawReader
+from dataset.const import KEY_COL
+
+
+SPECIAL_VALUE = 'a55475b1'
+REFERENCE_DATE = datetime(2020, 10, 19)
+TOP_VALUE_POSTFIXES = ('L', 'T', 'M')
+PROFILE_MODES = ('exact', 'sample', 'stream')
+SAMPLE_BUCKETS = 1_000_000
+
+
+def missing(col: str, dtype: pl.DataType) -> pl.Expr:
+    """
+    Missing values the way pandas isnull sees them, nan included.
+    """
+    expr = pl.col(col).is_null()
+    if dtype.is_float():
+        expr = expr | pl.col(col).is_nan()
+    return expr
+
+
+def date_diff(col: str, dtype: pl.DataType, date: datetime = REFERENCE_DATE) -> pl.Expr:
+    """
+    Days from col to date, like (pd.to_datetime(date) - pd.to_datetime(col)).dt.days.
+    """
+    value = pl.col(col) if dtype.is_temporal() else pl.col(col).cast(pl.Utf8).str.to_datetime()
+    return (pl.lit(date) - value.cast(pl.Datetime('us'))).dt.total_days()
+
+
+def column_profile_exprs(schema: pl.Schema, period_cols: List[str] = None) -> Dict[str, Dict[str, pl.Expr]]:
+    """
+    Statistics of every column as scalar polars expressions.
+    """
+    period_cols = period_cols or []
+    exprs: Dict[str, Dict[str, pl.Expr]] = {}
+    for col, dtype in schema.items():
+        c = pl.col(col)
+        stats = {
+            'null_count': missing(col, dtype).sum(),
+            'first_null': missing(col, dtype).first(),
+        }
+        if dtype.is_numeric():
+            stats['nonpositive'] = (c <= 0).any()
+            stats['max'] = (c.fill_nan(None) if dtype.is_float() else c).max().cast(pl.Float64)
+            stats['lowest'] = (c.fill_nan(None) if dtype.is_float() else c).min().cast(pl.Float64)
+            stats['highest'] = stats['max']
+        if dtype.is_float():
+            stats['integral'] = (c.is_finite() & (c == c.floor())).all()
+        if dtype == pl.Boolean:
+            stats['nonpositive'] = (~c).any()
+        if dtype in (pl.Utf8, pl.Categorical):
+            stats['special'] = (c.cast(pl.Utf8) == SPECIAL_VALUE).any()
+            stats['lowest'] = c.cast(pl.Utf8).min()
+            stats['highest'] = c.cast(pl.Utf8).max()
+        if not dtype.is_numeric() and col[-1] in TOP_VALUE_POSTFIXES:
+            # value counts in order of first appearance, like pandas value_counts before sorting
+            stats['values'] = c.drop_nulls().unique(maintain_order=True).implode()
+            stats['counts'] = c.drop_nulls().unique_counts().implode()
+        if col in period_cols and col[-1] == 'D' and not dtype.is_numeric():
+            stats['date_diff_max'] = date_diff(col, dtype).max().cast(pl.Float64)
+        exprs[col] = stats
+    return exprs
+
+
+def pandas_dtypes(schema: pl.Schema, null_counts: Dict[str, int]) -> Dict[str, str]:
+    """
+    dtype of every column once read with pd.read_parquet.
+    """
+    dtypes = pl.DataFrame(schema=schema).to_arrow().to_pandas().dtypes
+    result = {}
+    for col, dtype in schema.items():
+        result[col] = str(dtypes[col])
+        # arrow turns integers with nulls into float64 and booleans with nulls into objects
+        if null_counts[col] > 0 and dtype.is_integer():
+            result[col] = 'float64'
+        elif null_counts[col] > 0 and dtype == pl.Boolean:
+            result[col] = 'object'
+    return result
+
+
+def profile_columns(
+    frame: Union[pl.DataFrame, pl.LazyFrame], period_cols: List[str] = None
+) -> Dict[str, dict]:
+    """
+    Profile of every column in a single pass over frame: row and null counts,
+    whether the first value is missing, integrality, non positive values,
+    special values, max, lowest and highest values, value counts of categorical columns and the largest
+    day difference of period columns.
+    """
+    frame = frame.lazy()
+    schema = frame.collect_schema()
+    exprs = column_profile_exprs(schema, period_cols)
+    row = frame.select(
+        pl.len().alias('rows'),
+        *[expr.alias(f'{col}/{stat}') for col, stats in exprs.items() for stat, expr in stats.items()],
+    ).collect(engine='streaming').row(0, named=True)
+
+    profiles = {col: {'rows': row['rows'], 'polars_dtype': dtype} for col, dtype in schema.items()}
+    for key, value in row.items():
+        if key != 'rows':
+            col, stat = key.rsplit('/', 1)
+            profiles[col][stat] = value
+    return _with_pandas_dtypes(profiles)
+
+
+def _with_pandas_dtypes(profiles: Dict[str, dict]) -> Dict[str, dict]:
+    schema = pl.Schema({col: profile['polars_dtype'] for col, profile in profiles.items()})
+    null_counts = {col: profile['null_count'] for col, profile in profiles.items()}
+    for col, dtype in pandas_dtypes(schema, null_counts).items():
+        profiles[col]['dtype'] = dtype
+    return profiles
+
+
+def merge_counts(
+    left: Tuple[List, List[int]], right: Tuple[List, List[int]], capacity: int = None
+) -> Tuple[List, List[int]]:
+    """
+    Value counts of two chunks, in order of first appearance. With capacity
+    they are kept as a Misra-Gries summary: every value more frequent than
+    rows / (capacity + 1) survives, with its count lowered by at most that.
+    """
+    counts = dict(zip(*left))
+    for value, count in zip(*right):
+        counts[value] = counts.get(value, 0) + count
+    if capacity is not None and len(counts) > capacity:
+        threshold = sorted(counts.values(), reverse=True)[capacity]
+        counts = {value: count - threshold for value, count in counts.items() if count > threshold}
+    return list(counts), list(counts.values())
+
+
+def merge_profiles(
+    left: Dict[str, dict], right: Dict[str, dict], capacity: int = None
+) -> Dict[str, dict]:
+    """
+    Profile of two consecutive chunks of the same table from their profiles.
+    """
+    merged = {}
+    for col, b in right.items():
+        a = left[col] if left is not None else {'rows': 0, 'null_count': 0}
+        m = dict(b) if a['rows'] == 0 else dict(a)
+        m['rows'] = a['rows'] + b['rows']
+        m['null_count'] = a['null_count'] + b['null_count']
+        for stat in ('nonpositive', 'special'):
+            if stat in b:
+                m[stat] = bool(a.get(stat)) or bool(b[stat])
+        if 'integral' in b:
+            m['integral'] = a.get('integral', True) and b['integral']
+        for stat in ('max', 'highest', 'date_diff_max'):
+            if stat in b:
+                values = [value for value in (a.get(stat), b[stat]) if value is not None]
+                m[stat] = max(values) if len(values) > 0 else None
+        if 'lowest' in b:
+            values = [value for value in (a.get('lowest'), b['lowest']) if value is not None]
+            m['lowest'] = min(values) if len(values) > 0 else None
+        if 'values' in b:
+            m['values'], m['counts'] = merge_counts(
+                (a.get('values', []), a.get('counts', [])), (b['values'], b['counts']), capacity
+            )
+        merged[col] = m
+    return _with_pandas_dtypes(merged)
+
+
+def stream_profile(
+    frames: Iterable[Union[pl.DataFrame, pl.LazyFrame]], period_cols: List[str] = None, capacity: int = None
+) -> Dict[str, dict]:
+    """
+    Profile of the concatenation of frames, holding one frame at a time.
+    """
+    profiles = None
+    for frame in frames:
+        profiles = merge_profiles(profiles, profile_columns(frame, period_cols), capacity)
+    if profiles is None:
+        raise ValueError('frames is empty.')
+    return profiles
+
+
+def sample_cases(
+    frame: Union[pl.DataFrame, pl.LazyFrame], fraction: float, seed: int = 0
+) -> pl.LazyFrame:
+    """
+    Rows of a fraction of the cases, picked by a hash of case_id, so every
+    picked case keeps all of its rows.
+    """
+    threshold = int(fraction * SAMPLE_BUCKETS)
+    return frame.lazy().filter(pl.col(KEY_COL[0]).hash(seed) % SAMPLE_BUCKETS < threshold)
+
+
+class ColumnProfiler:
+    """
+    Column profiles of a topic for FeatureDefiner.
+
+    'exact' profiles the whole table in one streaming pass. 'sample' profiles
+    a fraction of the cases (see sample_cases). 'stream' profiles record
+    batches of batch_size rows one at a time and merges them, keeping value
+    counts as Misra-Gries summaries of capacity values, so memory is bounded
+    by batch_size and capacity whatever the size of the table.
+
+    Args:
+        mode (str): 'exact', 'sample' or 'stream'.
+        fraction (float): fraction of the cases profiled in 'sample' mode.
+        batch_size (int): rows of a record batch in 'stream' mode.
+        capacity (int): values kept per column in 'stream' mode, None keeps all.
+        seed (int): seed of the case hash in 'sample' mode.
+    """
+
+    def __init__(
+        self,
+        mode: str = 'exact',
+        fraction: float = 0.1,
+        batch_size: int = 500_000,
+        capacity: int = 1000,
+        seed: int = 0,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'mode should be one of {PROFILE_MODES}. Not {mode}.')
+        self.mode = mode
+        self.fraction = fraction
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.seed = seed
+
+    def profile(
+        self,
+        rawinfo: RawInfo,
+        topic: str,
+        depth: int = 1,
+        stage: str = 'prep',
+        period_cols: List[str] = None,
+    ) -> Dict[str, dict]:
+        if self.mode == 'stream':
+            batches = rawinfo.read_raw_iter(
+                topic, depth=depth, reader=RawReader('polars'), stage=stage, batch_size=self.batch_size
+            )
+            return stream_profile(batches, period_cols, self.capacity)
+
+        frame = rawinfo.read_raw(topic, depth=depth, reader=RawReader('lazy'), stage=stage)
+        if self.mode == 'sample':
+            frame = sample_cases(frame, self.fraction, self.seed)
+        return profile_columns(frame, period_cols)
+
+
+def top_values(profile: dict, k: int) -> List:
+    """
+    The k most frequent values, in the order of pandas value_counts.
+    """
+    counts = pd.Series(profile.get('counts', []), index=pd.Index(profile.get('values', []), dtype=object))
+    return list(counts.sort_values(ascending=False).index[:k])
+
+
+def first_max(profile: dict, stat: str = 'max') -> float:
+    """
+    python max over the column in file order, nan when its first value is
+    missing since nan never compares greater.
+    """
+    if profile['rows'] == 0:
+        raise ValueError('max() arg is an empty sequence')
+    if stat not in profile:
+        raise ValueError(f'{stat} is not profiled for this column')
+    if profile['first_null'] or profile[stat] is None:
+        return math.nan
+    return profile[stat]
@@ -0,0 +1,616 @@
+import re
+from typing import Dict, List, Tuple
+import polars as pl
+
+from dataset.feature.feature import Column, Filter, Agg, Feature
+from dataset.const import DATE_COL
+
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<string>'[^']*')|(?P<number>\d+(?:\.\d+)?)|(?P<ident>[A-Za-z_][A-Za-z0-9_]*)"
+    r"|(?P<op><=|>=|!=|<>|=|<|>|\(|\)|\+|-|\*|/|,))"
+)
+
+CAST_TYPES: Dict[str, pl.DataType] = {
+    'int': pl.Int32,
+    'integer': pl.Int32,
+    'bigint': pl.Int64,
+    'float': pl.Float64,
+    'float32': pl.Float64,
+    'double': pl.Float64,
+    'string': pl.Utf8,
+    'varchar': pl.Utf8,
+}
+
+COMPARISONS = {
+    '=': lambda l, r: l == r,
+    '!=': lambda l, r: l != r,
+    '<>': lambda l, r: l != r,
+    '<': lambda l, r: l < r,
+    '<=': lambda l, r: l <= r,
+    '>': lambda l, r: l > r,
+    '>=': lambda l, r: l >= r,
+}
+
+AGGREGATIONS = {
+    'count': lambda e: e.count(),
+    'sum': lambda e: pl.when(e.count() > 0).then(e.sum()),
+    'min': lambda e: e.min(),
+    'max': lambda e: e.max(),
+    'avg': lambda e: e.mean(),
+    'stddev': lambda e: e.std(),
+}
+
+# partial reductions of a fused value, and the partials each aggregation is derived from.
+# stddev keeps polars' own std: a sum of squares cancels out on large amounts
+# with a small spread, and shifting it needs a second pass over each group.
+# avg sums integers as floats like mean does, their own sum wraps around
+PARTIALS = {
+    'count': lambda e: e.count(),
+    'sum': lambda e: e.sum(),
+    'float_sum': lambda e: e.cast(pl.Float64).sum(),
+    'min': lambda e: e.min(),
+    'max': lambda e: e.max(),
+    'std': lambda e: e.std(),
+}
+
+FUSED_PARTIALS = {
+    'count': ['count'],
+    'sum': ['count', 'sum'],
+    'min': ['min'],
+    'max': ['max'],
+    'avg': ['count', 'float_sum'],
+    'stddev': ['std'],
+}
+
+FUSED_AGGREGATIONS = {
+    'count': lambda p: p['count'],
+    'sum': lambda p: pl.when(p['count'] > 0).then(p['sum']),
+    'min': lambda p: p['min'],
+    'max': lambda p: p['max'],
+    'avg': lambda p: pl.when(p['count'] > 0).then(p['float_sum'] / p['count']),
+    'stddev': lambda p: p['std'],
+}
+
+
+class ExprCompiler:
+    """
+    Compile Column, Filter and Agg trees into native polars expressions.
+
+    Filters and aggregations are stored as SQL fragments, so the compiler parses
+    the small SQL subset produced by FeatureDefiner (comparisons, is [not] null,
+    and/or, date arithmetic and the aggregations in AGGREGATIONS). Anything
+    outside of it raises NotImplementedError so callers can fall back to SQL.
+
+    Args:
+        schema (Dict[str, pl.DataType]): schema of the frame the expressions run on.
+            Used to decide how DATE() is applied to a column.
+    """
+
+    def __init__(self, schema: Dict[str, pl.DataType] = None):
+        self.schema = schema if schema is not None else {}
+
+    def compile_column(self, column: Column) -> pl.Expr:
+        if column.query is None:
+            return pl.col(column.name)
+        if re.fullmatch(r'\s*\d+\s*', column.query):
+            # broadcast constant columns like count(1) to the group length
+            return pl.repeat(int(column.query), pl.len())
+        expr, _ = _Parser(column.query, self).parse_value()
+        return expr
+
+    def compile_filter(self, filter: Filter) -> pl.Expr:
+        return _Parser(filter.logic, self).parse_predicate()
+
+    def compile_filters(self, filters: List[Filter]) -> pl.Expr:
+        if len(filters) == 0:
+            return None
+        mask = self.compile_filter(filters[0])
+        for filter in filters[1:]:
+            mask = mask & self.compile_filter(filter)
+        return mask
+
+    @staticmethod
+    def filter_key(filters: List[Filter]) -> str:
+        return " and ".join(map(str, filters))
+
+    def compile_masks(self, features: List[Feature]) -> Tuple[List[pl.Expr], Dict[str, str]]:
+        """
+        Deduplicate the filter conditions of a feature batch.
+        Returns one boolean column expression per distinct condition and
+        the mapping from condition to the mask column name.
+        """
+        mask_exprs: List[pl.Expr] = []
+        masks: Dict[str, str] = {}
+        for feature in features:
+            key = self.filter_key(feature.filters)
+            if len(feature.filters) == 0 or key in masks:
+                continue
+            try:
+                mask = self.compile_filters(feature.filters)
+            except NotImplementedError:
+                continue
+            masks[key] = f'__mask_{len(masks)}__'
+            mask_exprs.append(mask.alias(masks[key]))
+        return mask_exprs, masks
+
+    @staticmethod
+    def _split_agg(agg: Agg) -> Tuple[str, bool, str]:
+        matched = re.fullmatch(r'\s*(\w+)\s*\(\s*(distinct\s+)?(.*)\)\s*', agg.logic, re.I | re.S)
+        if matched is None:
+            raise NotImplementedError(f'Unsupported aggregation: {agg.logic}')
+        return matched.group(1).lower(), matched.group(2) is not None, matched.group(3)
+
+    def compile_value(self, agg: Agg, mask: pl.Expr = None) -> pl.Expr:
+        """
+        The value an aggregation reduces, null where mask is not met.
+        """
+        _, _, inner = self._split_agg(agg)
+        env = {}
+        placeholders = []
+        for i, column in enumerate(agg.columns):
+            value = self.compile_column(column)
+            if mask is not None:
+                value = pl.when(mask).then(value)
+            env[f'__agg_column_{i}__'] = value
+            placeholders.append(f'__agg_column_{i}__')
+
+        value, _ = _Parser(inner.format(*placeholders), self, env).parse_value()
+        return value
+
+    def compile_agg(self, agg: Agg, mask: pl.Expr = None) -> pl.Expr:
+        func, distinct, _ = self._split_agg(agg)
+        value = self.compile_value(agg, mask)
+        if distinct and func == 'count':
+            return value.drop_nulls().n_unique()
+        if distinct or func not in AGGREGATIONS:
+            raise NotImplementedError(f'Unsupported aggregation: {agg.logic}')
+        return AGGREGATIONS[func](value)
+
+    def fuse_features(
+        self, features: List[Feature], masks: Dict[str, str] = None
+    ) -> Tuple[List[pl.Expr], List[pl.Expr], List[pl.Expr], List[Feature]]:
+        """
+        Fuse the numeric aggregations of features reducing the same value under
+        the same filters.
+
+        Each group reduces its value once to the partials its features need
+        (count, sum, min, max, std) and every feature is derived from them
+        after the group by, e.g. sum and avg both from count and sum. Values
+        computed from more than a column (date differences, arithmetic) are
+        materialized before the group by, so the partials stay plain column
+        reductions instead of evaluating the value inside every group.
+        Returns the value columns, the partial aggregations, the derived
+        feature expressions and the features left for compile_features.
+        """
+        masks = masks if masks is not None else {}
+        groups: Dict[Tuple[str, str], List[Tuple[str, Feature]]] = {}
+        values: Dict[Tuple[str, str], pl.Expr] = {}
+        computed: Dict[Tuple[str, str], bool] = {}
+        rest: List[Feature] = []
+        for feature in features:
+            try:
+                func, distinct, inner = self._split_agg(feature.agg)
+                key = self.filter_key(feature.filters)
+                if (
+                    distinct
+                    or func not in FUSED_PARTIALS
+                    or feature.agg.data_type not in CAST_TYPES
+                    or (len(feature.filters) > 0 and key not in masks)
+                ):
+                    raise NotImplementedError(f'{feature.name} is not fusable')
+                group = (inner.format(*[c.query or c.name for c in feature.agg.columns]), key)
+                if group not in values:
+                    mask = pl.col(masks[key]) if key in masks else None
+                    values[group] = self.compile_value(feature.agg, mask)
+                    computed[group] = inner.strip() != '{0}' or feature.agg.columns[0].query is not None
+            except NotImplementedError:
+                rest.append(feature)
+                continue
+            groups.setdefault(group, []).append((func, feature))
+
+        # only numeric values can be fused, resolve their dtypes in one go
+        schema = {**self.schema, **{name: pl.Boolean for name in masks.values()}}
+        try:
+            dtypes = pl.LazyFrame(schema=schema).select(
+                [value.alias(f'__value_{i}__') for i, value in enumerate(values.values())]
+            ).collect_schema().dtypes()
+        except Exception:
+            return [], [], [], features
+
+        value_exprs: List[pl.Expr] = []
+        partials: List[pl.Expr] = []
+        derived: List[pl.Expr] = []
+        for i, (group, dtype) in enumerate(zip(values, dtypes)):
+            if not dtype.is_numeric():
+                rest += [feature for _, feature in groups[group]]
+                continue
+            value = values[group]
+            stats = {stat for func, _ in groups[group] for stat in FUSED_PARTIALS[func]}
+            if dtype.is_float():
+                value = value.cast(pl.Float64)
+                # the sum of a float value is its float sum
+                stats = {'sum' if stat == 'float_sum' else stat for stat in stats}
+            if computed[group]:
+                value_exprs.append(value.alias(f'__value_{i}__'))
+                value = pl.col(f'__value_{i}__')
+            names = {stat: f'__fused_{i}_{stat}__' for stat in stats}
+            partials += [PARTIALS[stat](value).alias(names[stat]) for stat in sorted(stats)]
+            cols = {stat: pl.col(name) for stat, name in names.items()}
+            if 'float_sum' not in cols and 'sum' in cols:
+                cols['float_sum'] = cols['sum']
+            derived += [
+                FUSED_AGGREGATIONS[func](cols)
+                .cast(CAST_TYPES[feature.agg.data_type])
+                .alias(feature.name)
+                for func, feature in groups[group]
+            ]
+        return value_exprs, partials, derived, rest
+
+    def compile_feature(self, feature: Feature, masks: Dict[str, str] = None) -> pl.Expr:
+        if feature.agg.data_type not in CAST_TYPES:
+            raise NotImplementedError(f'Unsupported data type: {feature.agg.data_type}')
+        key = self.filter_key(feature.filters)
+        if masks is not None and key in masks:
+            mask = pl.col(masks[key])
+        else:
+            mask = self.compile_filters(feature.filters)
+        return (
+            self.compile_agg(feature.agg, mask)
+            .cast(CAST_TYPES[feature.agg.data_type])
+            .alias(feature.name)
+        )
+
+    def compile_features(
+        self, features: List[Feature], masks: Dict[str, str] = None
+    ) -> Tuple[List[pl.Expr], List[Feature]]:
+        """
+        Compile features into expressions.
+        Returns compiled expressions and the features which need the SQL fallback.
+        """
+        exprs: List[pl.Expr] = []
+        unsupported: List[Feature] = []
+        for feature in features:
+            try:
+                exprs.append(self.compile_feature(feature, masks))
+            except NotImplementedError:
+                unsupported.append(feature)
+        return exprs, unsupported
+
+    def source_columns(self, features: List[Feature]) -> List[str]:
+        """
+        Union of the frame columns referenced by features, in first-seen order.
+        Columns of features needing the SQL fallback are taken from their
+        Column objects plus DATE_COL, which date arithmetic refers to by name.
+        """
+        columns: Dict[str, None] = {}
+        for feature in features:
+            try:
+                names = self.compile_feature(feature).meta.root_names()
+            except NotImplementedError:
+                names = [
+                    column.name
+                    for element in [feature.agg, *feature.filters]
+                    for column in element.columns
+                    if column.query is None
+                ] + DATE_COL
+            columns.update(dict.fromkeys(names))
+        return list(columns)
+
+    def to_date(self, expr: pl.Expr, name: str = None) -> pl.Expr:
+        dtype = self.schema.get(name)
+        if dtype is not None and dtype.is_temporal():
+            return expr.cast(pl.Date)
+        return expr.str.to_date()
+
+
+class _Parser:
+    """
+    Recursive descent parser over the SQL subset used by feature definitions.
+    Values are returned as (expr, kind) where kind is 'date' for DATE() results.
+    """
+
+    def __init__(self, text: str, compiler: ExprCompiler, env: Dict[str, pl.Expr] = None):
+        self.text = text
+        self.compiler = compiler
+        self.env = env if env is not None else {}
+        self.tokens = self._tokenize(text)
+        self.pos = 0
+
+    def _tokenize(self, text: str) -> List[Tuple[str, str]]:
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            matched = TOKEN_PATTERN.match(text, pos)
+            if matched is None or matched.end() == pos:
+                raise NotImplementedError(f'Unsupported expression: {text}')
+            tokens.append((matched.lastgroup, matched.group(matched.lastgroup)))
+            pos = matched.end()
+        return tokens
+
+    def _peek(self, offset: int = 0) -> Tuple[str, str]:
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def _next(self) -> Tuple[str, str]:
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _keyword(self, word: str) -> bool:
+        kind, value = self._peek()
+        if kind == 'ident' and value.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, value: str):
+        if self._next()[1] != value:
+            raise NotImplementedError(f'Unsupported expression: {self.text}')
+
+    def _done(self):
+        if self.pos != len(self.tokens):
+            raise NotImplementedError(f'Unsupported expression: {self.text}')
+
+    def parse_predicate(self) -> pl.Expr:
+        expr = self._or()
+        self._done()
+        return expr
+
+    def parse_value(self) -> Tuple[pl.Expr, str]:
+        value = self._additive()
+        self._done()
+        return value
+
+    def _or(self) -> pl.Expr:
+        expr = self._and()
+        while self._keyword('or'):
+            expr = expr | self._and()
+        return expr
+
+    def _and(self) -> pl.Expr:
+        expr = self._not()
+        while self._keyword('and'):
+            expr = expr & self._not()
+        return expr
+
+    def _not(self) -> pl.Expr:
+        if self._keyword('not'):
+            return ~self._not()
+        return self._comparison()
+
+    def _comparison(self) -> pl.Expr:
+        if self._peek()[1] == '(' and self._is_grouped_predicate():
+            self._next()
+            expr = self._or()
+            self._expect(')')
+            return expr
+
+        left, _ = self._additive()
+        if self._keyword('is'):
+            negate = self._keyword('not')
+            if not self._keyword('null'):
+                raise NotImplementedError(f'Unsupported expression: {self.text}')
+            return left.is_not_null() if negate else left.is_null()
+
+        kind, op = self._next()
+        if kind != 'op' or op not in COMPARISONS:
+            raise NotImplementedError(f'Unsupported expression: {self.text}')
+        right, _ = self._additive()
+        return COMPARISONS[op](left, right)
+
+    def _is_grouped_predicate(self) -> bool:
+        depth = 0
+        for kind, value in self.tokens[self.pos:]:
+            if value == '(':
+                depth += 1
+            elif value == ')':
+                depth -= 1
+                if depth == 0:
+                    return False
+            elif depth == 1 and (
+                value in COMPARISONS or (kind == 'ident' and value.lower() in ('and', 'or', 'is', 'not'))
+            ):
+                return True
+        return False
+
+    def _additive(self) -> Tuple[pl.Expr, str]:
+        left, left_kind = self._multiplicative()
+        while self._peek()[1] in ('+', '-'):
+            op = self._next()[1]
+            right, right_kind = self._multiplicative()
+            if left_kind == 'date' and right_kind == 'date' and op == '-':
+                left, left_kind = (left - right).dt.total_days(), 'value'
+            elif left_kind == 'date' or right_kind == 'date':
+                raise NotImplementedError(f'Unsupported expression: {self.text}')
+            else:
+                left = left + right if op == '+' else left - right
+        return left, left_kind
+
+    def _multiplicative(self) -> Tuple[pl.Expr, str]:
+        left, kind = self._unary()
+        while self._peek()[1] in ('*', '/'):
+            op = self._next()[1]
+            right, _ = self._unary()
+            left = left * right if op == '*' else left / right
+        return left, kind
+
+    def _unary(self) -> Tuple[pl.Expr, str]:
+        if self._peek()[1] == '-':
+            self._next()
+            value, kind = self._unary()
+            return -value, kind
+        return self._primary()
+
+    def _primary(self) -> Tuple[pl.Expr, str]:
+        kind, value = self._next()
+        if kind == 'number':
+            number = float(value) if '.' in value else int(value)
+            return pl.lit(number), 'value'
+        if kind == 'string':
+            return pl.lit(value[1:-1]), 'value'
+        if kind == 'op' and value == '(':
+            result = self._additive()
+            self._expect(')')
+            return result
+        if kind == 'ident' and value.lower() == 'null':
+            return pl.lit(None), 'value'
+        if kind == 'ident' and self._peek()[1] == '(':
+            if value.lower() != 'date':
+                raise NotImplementedError(f'Unsupported function: {value}')
+            self._next()
+            name = self._peek()[1]
+            inner, _ = self._additive()
+            self._expect(')')
+            return self.compiler.to_date(inner, name), 'date'
+        if kind == 'ident':
+            if value in self.env:
+                return self.env[value], 'value'
+            return pl.col(value), 'value'
+        raise NotImplementedError(f'Unsupported expression: {self.text}')
+
+
+def synthetic_frame(features: List[Feature], n_rows: int, n_cases: int, seed: int = 0) -> pl.DataFrame:
+    """
+    Random frame with every column the features reference, filter literals
+    included in the categorical values, for parity tests and benchmarks.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    columns: Dict[str, Column] = {}
+    literals: Dict[str, List[str]] = {}
+    for feature in features:
+        for element in [feature.agg, *feature.filters]:
+            for column in element.columns:
+                if column.query is None:
+                    columns[column.name] = column
+        for filter in feature.filters:
+            literals.setdefault(filter.columns[0].name, []).extend(re.findall(r"'([^']*)'", filter.logic))
+
+    data = {
+        'case_id': rng.integers(0, n_cases, n_rows),
+        'date_decision': ['2020-10-19'] * n_rows,
+    }
+    for name, column in columns.items():
+        if name in data:
+            continue
+        if column.data_type == 'object' and column.postfix == 'D':
+            days = rng.integers(0, 3000, n_rows)
+            values = (np.datetime64('2012-01-01') + days).astype(str).tolist()
+        elif column.data_type == 'object':
+            values = rng.choice(literals.get(name, []) + ['a55475b1', 'x', 'y'], n_rows).tolist()
+        else:
+            values = rng.integers(-5, 20, n_rows).astype(np.float64).tolist()
+        nulls = rng.random(n_rows) < 0.2
+        data[name] = [None if null else value for value, null in zip(values, nulls)]
+    frame = pl.DataFrame(data).with_columns(
+        [pl.col(name).cast(pl.Float32) for name, c in columns.items() if c.data_type == 'float32']
+    )
+    return frame.with_columns(target=(pl.col('case_id') % 2).cast(pl.Int64))
+
+
+if __name__ == "__main__":
+    ## parity test between the SQL path and the expression path
+    import glob
+    import json
+    import numpy as np
+    from polars.testing import assert_frame_equal, assert_series_equal
+    from dataset.feature.feature_loader import FeatureLoader
+
+    rng = np.random.default_rng(42)
+    n_rows = 2000
+
+    definitions = {}
+    for file in sorted(glob.glob('data/feature_definition_new/*.json')):
+        with open(file, 'r') as f:
+            definitions.update(json.load(f))
+    features: List[Feature] = [Feature.from_dict(feature) for feature in definitions.values()]
+
+    frame = synthetic_frame(features, n_rows, n_cases=200, seed=42)
+
+    compiler = ExprCompiler(frame.schema)
+    exprs, unsupported = compiler.compile_features(features)
+    print(f'[*] compiled {len(exprs)} / {len(features)} features')
+
+    # polars sql keeps DATE() differences as durations, the compiler uses days
+    date_features, expected_failed, sql_only_failed, mismatched = 0, 0, 0, 0
+    for i in range(0, len(features), 500):
+        batch = features[i:i + 500]
+        actual = FeatureLoader.query_expr(frame, batch, ['case_id', 'target']).sort('case_id')
+        for feature in batch:
+            if 'date(' in feature.query.lower():
+                date_features += 1
+                continue
+            try:
+                expected = FeatureLoader.query_sql(frame, [feature]).sort('case_id')
+            except Exception:
+                # sql rejects e.g. avg / stddev of string columns, where the expressions give nulls
+                expected_failed += 1
+                if actual[feature.name].null_count() < len(actual):
+                    sql_only_failed += 1
+                    print(f'[-] sql failed, expr computed: {feature.name}')
+                continue
+            try:
+                assert_series_equal(
+                    actual[feature.name], expected[feature.name],
+                    check_dtypes=False, rel_tol=1e-4,
+                )
+            except AssertionError:
+                mismatched += 1
+                print(f'[-] mismatch: {feature.name}')
+    print(f'[*] skipped {date_features} date features, sql path failed on {expected_failed} features')
+    print(f'[*] {mismatched} mismatches')
+    assert sql_only_failed == 0, f'sql path failed on {sql_only_failed} features the expression path computes'
+    assert mismatched == 0, f'{mismatched} features differ between the sql and expression paths'
+
+    ## fused against per-feature aggregation on numeric heavy topics
+    import time
+    large = frame.sample(500_000, with_replacement=True, seed=0).with_columns(
+        case_id=pl.Series(rng.integers(0, 50_000, 500_000))
+    )
+    for topic in ['tax_registry_a', 'tax_registry_b', 'tax_registry_c', 'deposit']:
+        batch = [feature for feature in features if feature.topic.startswith(topic)]
+        if len(batch) == 0:
+            continue
+        elapsed, results = {}, {}
+        for fuse in [False, True]:
+            query = FeatureLoader.compile_query(large.schema, batch, ['case_id'], fuse=fuse)
+            start_time = time.perf_counter()
+            results[fuse] = query.execute(large).sort('case_id')
+            elapsed[fuse] = time.perf_counter() - start_time
+        # date features are not covered by the sql parity above, compare them here
+        assert_frame_equal(results[False], results[True], rel_tol=1e-6)
+        print(
+            f'[*] {topic}: {len(batch)} features, {len(query.derived)} fused, '
+            f'{elapsed[False]:.2f}s unfused, {elapsed[True]:.2f}s fused'
+        )
+
+    ## fused against per-feature aggregation on integers near their type limits
+    limits = {pl.Int8: 127, pl.Int32: 2**31 - 1, pl.UInt32: 2**32 - 1, pl.Int64: 2**62}
+    extreme = pl.DataFrame({
+        'case_id': rng.integers(0, 20, n_rows),
+        **{
+            f'{dtype}_A'.lower(): pl.Series(rng.integers(limit - 10, limit, n_rows, endpoint=True), dtype=dtype)
+            for dtype, limit in limits.items()
+        },
+    })
+    batch = [
+        Feature(
+            data_type=data_type,
+            topic='extreme',
+            agg=Agg(columns=[Column(name=col, data_type=str(dtype).lower())], logic=logic, data_type=data_type),
+            filters=[],
+        )
+        for col, dtype in extreme.schema.items()
+        if col != 'case_id'
+        for logic, data_type in [('sum({0})', 'bigint'), ('avg({0})', 'float'), ('max({0})', 'bigint'), ('count({0})', 'int')]
+    ]
+    results = {
+        fuse: FeatureLoader.compile_query(extreme.schema, batch, ['case_id'], fuse=fuse).execute(extreme).sort('case_id')
+        for fuse in [False, True]
+    }
+    assert_frame_equal(results[False], results[True], rel_tol=1e-12)
+    print(f'[*] {len(batch)} features near the integer limits match fused')
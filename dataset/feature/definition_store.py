@@ -0,0 +1,274 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+from dataset.feature.feature import Agg, Column, Feature, Filter
+
+
+DEFINITION_SUFFIX = '.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS columns (
+    id INTEGER PRIMARY KEY,
+    data_type TEXT,
+    query TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS filters (
+    id INTEGER PRIMARY KEY,
+    logic TEXT,
+    columns TEXT
+);
+CREATE TABLE IF NOT EXISTS aggs (
+    id INTEGER PRIMARY KEY,
+    logic TEXT,
+    data_type TEXT,
+    columns TEXT
+);
+CREATE TABLE IF NOT EXISTS features (
+    position INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    data_type TEXT,
+    topic TEXT,
+    agg INTEGER,
+    filters TEXT
+);
+'''
+
+
+def _ids(text: str) -> List[int]:
+    return [int(i) for i in text.split(',')] if text else []
+
+
+class DefinitionStore:
+    """
+    Feature definitions of a topic in SQLite, normalized.
+
+    Columns, filters and aggregations are stored once and referenced by id
+    from the features, which are indexed by name. Loading features only
+    reads their rows and the parts they reference, builds each part once,
+    and restores features with their stored name instead of deriving it
+    from the query again, so loading a selection costs O(selected).
+
+    Args:
+        path (Path): store file, {topic}.sqlite next to the json definitions.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+        self._columns: Dict[int, Column] = {}
+        self._filters: Dict[int, Filter] = {}
+        self._aggs: Dict[int, Agg] = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT count(*) FROM features').fetchone()[0]
+
+    def __contains__(self, name: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM features WHERE name = ?', (name,)).fetchone() is not None
+
+    def names(self) -> List[str]:
+        return [name for name, in self.conn.execute('SELECT name FROM features ORDER BY position')]
+
+    def defined(self, names: List[str]) -> List[str]:
+        """
+        The names that are defined, in stored order.
+        """
+        result = []
+        for index in range(0, len(names), 900):
+            chunk = names[index : index + 900]
+            result += self.conn.execute(
+                f'SELECT position, name FROM features WHERE name IN ({",".join("?" * len(chunk))})', chunk
+            ).fetchall()
+        return [name for _, name in sorted(result)]
+
+    def write(self, features: List[Feature]):
+        """
+        Replace the definitions with features, interning their parts.
+        """
+        columns: Dict[Tuple, int] = {}
+        filters: Dict[Tuple, int] = {}
+        aggs: Dict[Tuple, int] = {}
+
+        def column_id(column: Column) -> int:
+            return columns.setdefault((column.data_type, column.query, column.name), len(columns))
+
+        def ids(element) -> str:
+            return ','.join(str(column_id(column)) for column in element.columns)
+
+        # one feature per name, the last one at the first position like a json object
+        features = list({feature.name: feature for feature in features}.values())
+        rows = []
+        for position, feature in enumerate(features):
+            agg = feature.agg
+            agg_id = aggs.setdefault((agg.logic, agg.data_type, ids(agg)), len(aggs))
+            filter_ids = [filters.setdefault((f.logic, ids(f)), len(filters)) for f in feature.filters]
+            rows.append((
+                position, feature.name, feature.data_type, feature.topic, agg_id,
+                ','.join(map(str, filter_ids)),
+            ))
+
+        with self.conn:
+            for table in ['columns', 'filters', 'aggs', 'features']:
+                self.conn.execute(f'DELETE FROM {table}')
+            self.conn.executemany(
+                'INSERT INTO columns VALUES (?, ?, ?, ?)', [(i, *key) for key, i in columns.items()]
+            )
+            self.conn.executemany(
+                'INSERT INTO filters VALUES (?, ?, ?)', [(i, *key) for key, i in filters.items()]
+            )
+            self.conn.executemany(
+                'INSERT INTO aggs VALUES (?, ?, ?, ?)', [(i, *key) for key, i in aggs.items()]
+            )
+            self.conn.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.execute('VACUUM')
+        self._columns, self._filters, self._aggs = {}, {}, {}
+
+    def _fetch(self, table: str, ids: List[int], cache: dict) -> List[tuple]:
+        missing = sorted(set(ids) - set(cache))
+        rows = []
+        # stay under the sqlite limit of bound parameters
+        for index in range(0, len(missing), 900):
+            chunk = missing[index : index + 900]
+            rows += self.conn.execute(
+                f'SELECT * FROM {table} WHERE id IN ({",".join("?" * len(chunk))})', chunk
+            ).fetchall()
+        return rows
+
+    def _parts(self, agg_ids: List[int], filter_ids: List[int]):
+        agg_rows = self._fetch('aggs', agg_ids, self._aggs)
+        filter_rows = self._fetch('filters', filter_ids, self._filters)
+        column_ids = [i for row in agg_rows for i in _ids(row[3])]
+        column_ids += [i for row in filter_rows for i in _ids(row[2])]
+        for id_, data_type, query, name in self._fetch('columns', column_ids, self._columns):
+            self._columns[id_] = Column(data_type, query=query, name=name)
+        for id_, logic, data_type, columns in agg_rows:
+            self._aggs[id_] = Agg([self._columns[i] for i in _ids(columns)], logic, data_type)
+        for id_, logic, columns in filter_rows:
+            self._filters[id_] = Filter([self._columns[i] for i in _ids(columns)], logic)
+
+    def _restore(self, rows: List[tuple]) -> List[Feature]:
+        self._parts([row[3] for row in rows], [i for row in rows for i in _ids(row[4])])
+        return [
+            Feature.restore(
+                data_type, topic, self._aggs[agg], [self._filters[i] for i in _ids(filters)], name
+            )
+            for name, data_type, topic, agg, filters in rows
+        ]
+
+    def load(self, names: List[str] = None) -> List[Feature]:
+        """
+        Features by name, in the order of names, or every feature in stored order.
+        """
+        select = 'SELECT name, data_type, topic, agg, filters FROM features'
+        if names is None:
+            return self._restore(self.conn.execute(f'{select} ORDER BY position').fetchall())
+
+        rows = {}
+        for index in range(0, len(names), 900):
+            chunk = names[index : index + 900]
+            for row in self.conn.execute(f'{select} WHERE name IN ({",".join("?" * len(chunk))})', chunk):
+                rows[row[0]] = row
+        missing = [name for name in names if name not in rows]
+        if len(missing) > 0:
+            raise KeyError(f'{len(missing)} features are not defined, e.g. {missing[0]}')
+        return self._restore([rows[name] for name in names])
+
+    def iter_batches(self, batch_size: int) -> Iterator[List[Feature]]:
+        """
+        Every feature in stored order, batch_size at a time.
+        """
+        names = self.names()
+        for index in range(0, len(names), batch_size):
+            yield self.load(names[index : index + batch_size])
+
+    @staticmethod
+    def from_json(json_path: Path, path: Path = None) -> 'DefinitionStore':
+        """
+        Store of the definitions in a {topic}.json file, next to it by default.
+        """
+        json_path = Path(json_path)
+        path = Path(path) if path is not None else json_path.with_suffix(DEFINITION_SUFFIX)
+        with open(json_path, 'r') as f:
+            features = [Feature.from_dict(feature) for feature in json.load(f).values()]
+        store = DefinitionStore(path)
+        store.write(features)
+        return store
+
+
+def definition_path(def_path: Path, topic: str) -> Path:
+    """
+    Definitions file of topic: its store, or its json file when no store was
+    written. A json newer than the store was regenerated after it, so the two
+    may differ and neither is picked.
+    """
+    store_path = Path(def_path) / f'{topic}{DEFINITION_SUFFIX}'
+    json_path = Path(def_path) / f'{topic}.json'
+    if store_path.exists():
+        if json_path.exists() and os.stat(json_path).st_mtime_ns > os.stat(store_path).st_mtime_ns:
+            raise ValueError(
+                f'{json_path} is newer than {store_path}. '
+                'Rebuild the store with DefinitionStore.from_json or remove one of them.'
+            )
+        return store_path
+    if json_path.exists():
+        return json_path
+    raise FileNotFoundError(f'Feature definition for {topic} not found.')
+
+
+def load_definitions(def_path: Path, topic: str, names: List[str] = None) -> List[Feature]:
+    """
+    Features of topic from its definitions file, see definition_path.
+    """
+    path = definition_path(def_path, topic)
+    if path.suffix == DEFINITION_SUFFIX:
+        store = DefinitionStore(path)
+        try:
+            return store.load(names)
+        finally:
+            store.close()
+
+    with open(path, 'r') as f:
+        features = json.load(f)
+    if names is None:
+        return [Feature.from_dict(feature) for feature in features.values()]
+    return [Feature.from_dict(features[name]) for name in names]
+
+
+if __name__ == '__main__':
+    ## size and load time of a selection against the json definitions
+    import sys
+    import time
+    from dataset.feature.feature_definer import FEATURE_DEF_PATH
+
+    topic = sys.argv[1] if len(sys.argv) > 1 else 'applprev'
+    n_selected = 500
+    json_path = FEATURE_DEF_PATH / f'{topic}.json'
+    store = DefinitionStore.from_json(json_path, FEATURE_DEF_PATH / f'{topic}_bench{DEFINITION_SUFFIX}')
+    names = store.names()[:: max(1, len(store) // n_selected)][:n_selected]
+
+    start_time = time.perf_counter()
+    with open(json_path, 'r') as f:
+        definitions = json.load(f)
+    from_json = [Feature.from_dict(definitions[name]) for name in names]
+    json_sec = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    from_store = DefinitionStore(store.path).load(names)
+    store_sec = time.perf_counter() - start_time
+
+    assert [f.to_dict() for f in from_json] == [f.to_dict() for f in from_store]
+    assert [(f.name, f.query) for f in from_json] == [(f.name, f.query) for f in from_store]
+    print(
+        f'[*] {topic}: {len(store)} features, json {os.path.getsize(json_path) / 1024 ** 2:.2f} MB, '
+        f'store {os.path.getsize(store.path) / 1024 ** 2:.2f} MB'
+    )
+    print(f'[*] {len(names)} selected features: json {json_sec:.3f}s, store {store_sec:.3f}s')
+    store.close()
+    os.remove(store.path)
@@ -170,6 +170,20 @@ class Feature(Column):
         data.pop("filters")
         return Feature(agg=agg, filters=filters, **data)
 
+    @staticmethod
+    def restore(data_type: str, topic: str, agg: Agg, filters: List[Filter], name: str):
+        """
+        Feature with a name derived before, e.g. read from a definition store,
+        so the naming replacements are not run again.
+        """
+        feature = Feature.__new__(Feature)
+        Column.__init__(feature, data_type, name=name)
+        feature.topic = topic
+        feature.agg = agg
+        feature.filters = filters
+        feature.query = feature._init_query()
+        return feature
+
 
 if __name__ == "__main__":
     ## test code
@@ -0,0 +1,233 @@
+import gc
+import multiprocessing.context
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Union
+import polars as pl
+
+from dataset.feature.feature import Feature
+from dataset.feature.feature_loader import FeatureLoader
+from dataset.feature.compiler import ExprCompiler
+from dataset.feature.util import DtypePlanStore, optimize_dataframe, limit_memory
+from dataset.datainfo import PREP_FORMATS, write_frame
+from dataset.const import KEY_COL
+
+
+SHARD_COL = '__shard__'
+_ENVIRON_LOCK = threading.Lock()
+
+
+class _PolarsProcess(multiprocessing.context.SpawnProcess):
+    """
+    Spawned process whose polars thread pool is capped at polars_threads.
+    polars sizes its pool from POLARS_MAX_THREADS when it is imported, which
+    happens while the child unpickles its target, before any pool initializer
+    runs, so the variable is set in the environment the child inherits at start.
+    """
+
+    polars_threads: int = None
+
+    def start(self):
+        with _ENVIRON_LOCK:
+            threads = os.environ.get('POLARS_MAX_THREADS')
+            os.environ['POLARS_MAX_THREADS'] = str(self.polars_threads)
+            try:
+                super().start()
+            finally:
+                if threads is None:
+                    os.environ.pop('POLARS_MAX_THREADS', None)
+                else:
+                    os.environ['POLARS_MAX_THREADS'] = threads
+
+
+class _SpawnContext(multiprocessing.context.SpawnContext):
+    def __init__(self, polars_threads: int):
+        super().__init__()
+        self.polars_threads = polars_threads
+
+    def Process(self, *args, **kwargs):
+        process = _PolarsProcess(*args, **kwargs)
+        process.polars_threads = self.polars_threads
+        return process
+
+
+def _build_shard(
+    shard_path: Path, features: List[Feature], group_cols: List[str], output_path: Path
+) -> Path:
+    frame = pl.scan_parquet(shard_path / '*.parquet')
+    temp = FeatureLoader.query_expr(frame, features, group_cols)
+    temp.write_parquet(output_path)
+    del temp
+    gc.collect()
+    return output_path
+
+
+class ShardedFeatureBuilder:
+    """
+    Build features in a process pool over case_id shards.
+
+    Every feature is a group by case_id aggregate, so the joined frame is hash
+    partitioned by case_id into n_shards parquet directories once, and each
+    (batch, shard) pair is built by a worker. Per-shard outputs of a batch are
+    concatenated and cast to the dtype plan once all its shards are done.
+
+    Args:
+        n_shards (int): number of case_id hash partitions.
+        n_workers (int): number of worker processes. Defaults to the cpu count.
+        memory_limit_mb (int): address space cap of each worker (unix only).
+        temp_dir (Path): where shards and per-shard outputs are written.
+        prefetch (int): batches queued in the pool ahead of the one being read.
+        dtypes (DtypePlanStore): the persisted feature dtype plan of the topic,
+            batches are only downcast with optimize_dataframe without one.
+    """
+
+    def __init__(
+        self,
+        n_shards: int = 32,
+        n_workers: int = None,
+        memory_limit_mb: int = None,
+        temp_dir: Path = None,
+        prefetch: int = 2,
+        dtypes: DtypePlanStore = None,
+    ):
+        self.n_shards = n_shards
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.memory_limit_mb = memory_limit_mb
+        self.temp_dir = temp_dir
+        self.prefetch = max(1, prefetch)
+        self.dtypes = dtypes
+
+    def partition(
+        self,
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        shard_dir: Path,
+        columns: List[str] = None,
+    ) -> List[Path]:
+        """
+        Stream the shards of frame to shard_dir/__shard__=k in a single pass:
+        the input is scanned and joined once by a partitioned sink, so it is
+        never collected. Only columns (and the key) are written when given.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        frame = frame.lazy()
+        if columns is not None:
+            schema = frame.collect_schema()
+            frame = frame.select(
+                [c for c in dict.fromkeys([*KEY_COL, *columns]) if c in schema]
+            )
+        frame = frame.with_columns(
+            (pl.col(KEY_COL[0]).hash(seed=0) % self.n_shards).alias(SHARD_COL)
+        )
+        frame.sink_parquet(
+            pl.PartitionBy(
+                shard_dir, key=SHARD_COL, include_key=False, approximate_bytes_per_file=None
+            )
+        )
+        shard_paths = []
+        empty = None
+        for shard in range(self.n_shards):
+            shard_path = Path(shard_dir) / f'{SHARD_COL}={shard}'
+            # shards without rows get no file from the sink
+            if not shard_path.exists():
+                if empty is None:
+                    empty = pl.DataFrame(schema=frame.drop(SHARD_COL).collect_schema())
+                os.makedirs(shard_path)
+                empty.write_parquet(shard_path / '00000000.parquet')
+            shard_paths.append(shard_path)
+        return shard_paths
+
+    def build_batches(
+        self,
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        features: List[Feature],
+        group_cols: List[str],
+        batch_size: int,
+        skip: int = 0,
+    ) -> Iterator[pl.DataFrame]:
+        """
+        Yield the feature data of each batch, in order.
+        Skipped batches yield None like FeatureLoader.load_feature_data_batch.
+        """
+        work_dir = Path(tempfile.mkdtemp(prefix='feature_shards_', dir=self.temp_dir))
+        try:
+            start_time = time.time()
+            shard_paths = self.partition(
+                frame, work_dir / 'shards', [*group_cols, *ExprCompiler().source_columns(features)]
+            )
+            print(f'[*] Partitioned into {self.n_shards} shards: {time.time() - start_time:.4f} sec')
+
+            batches = list(range(0, len(features), batch_size))
+            with ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=_SpawnContext(max(1, (os.cpu_count() or 1) // self.n_workers)),
+                initializer=limit_memory,
+                initargs=(self.memory_limit_mb,),
+            ) as executor:
+                futures = {}
+
+                def submit(i: int):
+                    index = batches[i]
+                    os.makedirs(work_dir / f'batch_{i}', exist_ok=True)
+                    futures[i] = [
+                        executor.submit(
+                            _build_shard,
+                            shard_path,
+                            features[index : index + batch_size],
+                            group_cols,
+                            work_dir / f'batch_{i}' / f'{shard_path.name}.parquet',
+                        )
+                        for shard_path in shard_paths
+                    ]
+
+                # at most prefetch batches are queued, so the pool never holds
+                # every batch x shard task and their outputs at once
+                queued = iter(range(skip, len(batches)))
+                for i in islice(queued, self.prefetch):
+                    submit(i)
+
+                for i in range(len(batches)):
+                    if i < skip:
+                        yield None
+                        continue
+                    outputs = [future.result() for future in futures.pop(i)]
+                    for j in islice(queued, 1):
+                        submit(j)
+                    temp = pl.concat(
+                        [pl.read_parquet(output) for output in outputs], how='vertical_relaxed'
+                    )
+                    shutil.rmtree(work_dir / f'batch_{i}')
+                    if self.dtypes is not None:
+                        yield self.dtypes.apply(temp)
+                    else:
+                        yield optimize_dataframe(temp)
+            print(f'[*] Elapsed time: {time.time() - start_time:.4f} sec')
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def build(
+        self,
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        features: List[Feature],
+        group_cols: List[str],
+        batch_size: int,
+        output_dir: Path,
+        prefix: str,
+        start_index: int = 0,
+        format: str = 'parquet',
+    ) -> List[Path]:
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        batches = self.build_batches(frame, features, group_cols, batch_size)
+        for i, temp in enumerate(batches, start=start_index):
+            path = Path(output_dir) / f'{prefix}_{i}{PREP_FORMATS[format]}'
+            write_frame(temp, path)
+            paths.append(path)
+            del temp
+            gc.collect()
+        return paths
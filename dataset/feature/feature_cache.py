@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+import polars as pl
+
+from dataset.datainfo import DATA_PATH, PREP_FORMATS, read_frame, write_frame
+from dataset.feature.feature import Feature
+
+
+FEATURE_CACHE_PATH = DATA_PATH / 'feature_cache'
+
+
+class FeatureCache:
+    """
+    Content addressed on-disk cache of computed feature columns.
+
+    Each feature column is stored as its own file (group columns plus the
+    feature), parquet or memory mapped Arrow IPC, named by a hash of Feature.to_dict(), the engine and the
+    fingerprint of the input files. Redefining a feature or rewriting an input
+    file changes the key, so stale entries are never read and age out through
+    the LRU eviction.
+
+    get, put and evict may be called from several threads sharing the cache,
+    the counters of report are updated under a lock.
+
+    Args:
+        cache_dir (Path): directory of the cached columns.
+        max_bytes (int): disk budget. Least recently used columns are evicted
+            once the cache grows past it. None disables eviction.
+        format (str): 'parquet' or 'ipc'.
+    """
+
+    def __init__(self, cache_dir: Path = None, max_bytes: int = None, format: str = 'parquet'):
+        if format not in PREP_FORMATS:
+            raise ValueError(f'format should be one of {list(PREP_FORMATS)}. Not {format}.')
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else FEATURE_CACHE_PATH
+        self.max_bytes = max_bytes
+        self.suffix = PREP_FORMATS[format]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(paths: List[Path]) -> str:
+        """
+        Fingerprint of input files from their path, size and mtime.
+        """
+        stats = []
+        for path in sorted(map(str, paths)):
+            stat = os.stat(path)
+            stats.append((path, stat.st_size, stat.st_mtime_ns))
+        return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+    @staticmethod
+    def key(feature: Feature, fingerprint: str, engine: str = 'expr') -> str:
+        definition = json.dumps(feature.to_dict(), sort_keys=True)
+        return hashlib.sha1(f'{definition}|{engine}|{fingerprint}'.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}{self.suffix}'
+
+    def get(
+        self, features: List[Feature], fingerprint: str, engine: str = 'expr'
+    ) -> Tuple[Dict[str, pl.DataFrame], List[Feature]]:
+        """
+        Look up features in the cache.
+        Returns cached columns by feature name and the features to compute.
+        """
+        cached: Dict[str, pl.DataFrame] = {}
+        missing: List[Feature] = []
+        for feature in features:
+            path = self._path(self.key(feature, fingerprint, engine))
+            try:
+                cached[feature.name] = read_frame(path)
+                os.utime(path)
+            except FileNotFoundError:
+                # never written, or evicted by another thread
+                cached.pop(feature.name, None)
+                missing.append(feature)
+        with self._lock:
+            self.hits += len(cached)
+            self.misses += len(missing)
+        return cached, missing
+
+    def put(
+        self,
+        features: List[Feature],
+        fingerprint: str,
+        data: pl.DataFrame,
+        group_cols: List[str],
+        engine: str = 'expr',
+    ):
+        for feature in features:
+            path = self._path(self.key(feature, fingerprint, engine))
+            # readers in other threads only ever see complete files
+            temp_path = path.with_name(f'.{threading.get_ident()}_{path.name}')
+            write_frame(data.select([*group_cols, feature.name]), temp_path)
+            os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            self._evict()
+
+    def _entries(self) -> List[os.DirEntry]:
+        # files being written by put start with a dot
+        return [
+            entry for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(self.suffix) and not entry.name.startswith('.')
+        ]
+
+    def _evict(self):
+        entries = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self._entries()]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def report(self) -> str:
+        with self._lock:
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        total = hits + misses
+        hit_rate = hits / total if total > 0 else 0.0
+        return (
+            f'[*] Feature cache: {hits} hits, {misses} misses '
+            f'({100 * hit_rate:.2f}% hit rate), {evictions} evictions, '
+            f'{self.size() / 1024 ** 2:.2f} MB on disk'
+        )
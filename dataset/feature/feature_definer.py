@@ -1,7 +1,9 @@
 import os
-import pandas as pd
 from dataset.datainfo import RawInfo, DATA_PATH
 from dataset.feature.feature import *
+from dataset.feature.column_profile import ColumnProfiler, top_values, first_max
+from dataset.feature.simplifier import FeatureSimplifier
+from dataset.feature.definition_store import DefinitionStore, DEFINITION_SUFFIX
 from typing import Dict, List
 import json
 
@@ -17,25 +19,34 @@ class FeatureDefiner:
         depth: int = 1,
         stage: str = 'prep',
         cnf: dict = None,
+        profiler: ColumnProfiler = None,
     ):
         self.topic: str = topic
-        self.rawdata: pd.DataFrame = RawInfo(cnf).read_raw(
-            self.topic, depth=depth, stage=stage
+        profiler = profiler if profiler is not None else ColumnProfiler()
+        # bounds of a sample do not decide filters
+        self.exact_profiles: bool = profiler.mode != 'sample'
+        self.profiles: Dict[str, dict] = profiler.profile(
+            RawInfo(cnf), self.topic, depth=depth, stage=stage, period_cols=period_cols
         )
         self.raw_cols: Dict[str, Column] = {
-            col: Column(name=col, data_type=str(type))
-            for col, type in self.rawdata.dtypes.items()
+            col: Column(name=col, data_type=profile['dtype'])
+            for col, profile in self.profiles.items()
             if col not in ('case_id')
         }
         self.numgroup: str = f'num_group{depth}'
         self.period_cols: List[str] = period_cols
         self._update_integer_data_type()
         self.features: List[Feature] = None
+        # dropped feature -> the feature it duplicates
+        self.duplicates: Dict[str, str] = {}
 
     def _update_integer_data_type(self):
         for col in self.raw_cols.values():
-            if col.data_type.startswith('float') and all(
-                self.rawdata[col.name].apply(lambda x: x.is_integer())
+            profile = self.profiles[col.name]
+            if (
+                col.data_type.startswith('float')
+                and profile['null_count'] == 0
+                and profile.get('integral', False)
             ):
                 self.raw_cols[col.name].data_type = 'int64'
 
@@ -53,11 +64,13 @@ class FeatureDefiner:
         ]
         return features
 
-    def define_features(self):
+    def define_features(self, dedupe: bool = True):
         aggs = self.define_aggs()
         filters = self.define_filters(self.numgroup, self.period_cols)
         filters += [None]
         self.features = self.gen_features(aggs, filters)
+        if dedupe and self.exact_profiles:
+            self.features, self.duplicates = FeatureSimplifier(self.profiles).dedupe(self.features)
 
     def define_simple_features(self, cat_count: int = 10):
         self.raw_cols.pop('num_group1')
@@ -100,7 +113,7 @@ class FeatureDefiner:
         filters: List[Filter] = [
             Filter(columns=[col], logic=f"{col} = '{val}'")
             for col in filter_cols.values()
-            for val in self.rawdata[col.name].value_counts().index[:cat_count]
+            for val in top_values(self.profiles[col.name], cat_count)
             if val != 'a55475b1'
         ]
         return filters
@@ -118,16 +131,17 @@ class FeatureDefiner:
                 logic=f"date(date_decision)-date({col}) < {val}",
             )
             for col in period_cols.values()
-            for val in self.fibonacci(self.date_diff(self.rawdata[col.name]))[3:]
+            for val in self.fibonacci(first_max(self.profiles[col.name], 'date_diff_max'))[3:]
         ]
         return filters
 
     def null_filters(self):
         filters: List[Filter] = []
         for col in self.raw_cols.values():
-            hasnull = any(self.rawdata[col.name].isnull())
+            profile = self.profiles[col.name]
+            hasnull = profile['null_count'] > 0
             if col.data_type == 'object':
-                hasa55475b1 = any(self.rawdata[col.name] == 'a55475b1')
+                hasa55475b1 = profile.get('special', False)
                 if hasnull and hasa55475b1:
                     filters.append(Filter([col],f"{col} is null or {col} = 'a55475b1'"))
                     filters.append(Filter([col],f"{col} is not null and {col} != 'a55475b1'"))
@@ -138,7 +152,7 @@ class FeatureDefiner:
                     filters.append(Filter([col], f"{col} = 'a55475b1'"))
                     filters.append(Filter([col], f"{col} != 'a55475b1'"))
             else:
-                hasgezero = any(self.rawdata[col.name] <= 0)
+                hasgezero = profile.get('nonpositive', False)
                 if hasnull and hasgezero:
                     filters.append(Filter([col], f"{col} is null"))
                     filters.append(Filter([col], f"{col} is not null"))
@@ -156,7 +170,7 @@ class FeatureDefiner:
         filters: List[Filter] = []
         filters += [
             Filter(columns=[self.raw_cols[numgroup]], logic=f"{numgroup} < {val}")
-            for val in self.fibonacci(self.rawdata[numgroup])
+            for val in self.fibonacci(first_max(self.profiles[numgroup]))
         ]
         filters += [
             Filter(columns=[self.raw_cols[numgroup]], logic=f"{numgroup} = {val}")
@@ -244,30 +258,84 @@ class FeatureDefiner:
         return aggs
 
     @staticmethod
-    def fibonacci(target_series: pd.Series):
-        if target_series.dtype == 'object':
-            raise ValueError("target_series should be numeric")
-        max_value = max(target_series)
-
+    def fibonacci(max_value: float):
         fibonacci = [1, 2]
         while fibonacci[-1] < max_value:
             fibonacci.append(fibonacci[-1] + fibonacci[-2])
         fibonacci = fibonacci[1:]
         return fibonacci
 
-    @staticmethod
-    def date_diff(x: pd.Series, date='2020-10-19'):
-        if x.dtype == 'object':
-            x = pd.to_datetime(x)
-        return (pd.to_datetime(date) - x).dt.days
-
     def save_features_as_json(
         self,
         filename: str,
     ):
         self.save_json(self.features, filename)
 
+    def save_features(self, filename: str):
+        """
+        Save to a definition store for a .sqlite filename, as json otherwise.
+        """
+        if str(filename).endswith(DEFINITION_SUFFIX):
+            store = DefinitionStore(filename)
+            store.write(self.features)
+            store.close()
+        else:
+            self.save_json(self.features, filename)
+
     @staticmethod
     def save_json(features: List[Feature], filename: str):
         with open(filename, 'w') as f:
             json.dump({feature.name: feature.to_dict() for feature in features}, f)
+
+    def compare(self, other: 'FeatureDefiner') -> dict:
+        """
+        How far the definitions of other, e.g. from a sampled profile, are from these.
+        """
+        names = {feature.name for feature in self.features}
+        other_names = {feature.name for feature in other.features}
+        filters = {str(f) for feature in self.features for f in feature.filters if f is not None}
+        other_filters = {str(f) for feature in other.features for f in feature.filters if f is not None}
+        return {
+            'features': len(names),
+            'other_features': len(other_names),
+            'missing_features': len(names - other_names),
+            'extra_features': len(other_names - names),
+            'jaccard': len(names & other_names) / max(len(names | other_names), 1),
+            'dtypes': {
+                name: (col.data_type, other.raw_cols[name].data_type)
+                for name, col in self.raw_cols.items()
+                if name in other.raw_cols and col.data_type != other.raw_cols[name].data_type
+            },
+            'missing_filters': sorted(filters - other_filters),
+            'extra_filters': sorted(other_filters - filters),
+        }
+
+
+if __name__ == '__main__':
+    # definitions from sampled and streamed profiles against the exact ones
+    import time
+
+    topic, period_cols = 'credit_bureau_a', ['dateofcredstart_181D', 'dateofcredstart_739D']
+    profilers = {
+        'exact': ColumnProfiler('exact'),
+        'sample': ColumnProfiler('sample', fraction=0.1),
+        'stream': ColumnProfiler('stream', batch_size=500_000, capacity=100),
+    }
+    definers: Dict[str, FeatureDefiner] = {}
+    for name, profiler in profilers.items():
+        start_time = time.perf_counter()
+        definers[name] = FeatureDefiner(topic, period_cols=period_cols, profiler=profiler)
+        definers[name].define_features()
+        print(f'[*] {name}: {len(definers[name].features)} features in {time.perf_counter() - start_time:.2f}s')
+
+    for name in ['sample', 'stream']:
+        report = definers['exact'].compare(definers[name])
+        print(
+            f'[*] {name} vs exact: jaccard {report["jaccard"]:.4f}, '
+            f'{report["missing_features"]} missing, {report["extra_features"]} extra features, '
+            f'{len(report["dtypes"])} dtype changes'
+        )
+        for filter in report['missing_filters'][:10]:
+            print(f'    - {filter}')
+        for filter in report['extra_filters'][:10]:
+            print(f'    + {filter}')
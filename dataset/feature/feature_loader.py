@@ -3,21 +3,74 @@ import json
 import os
 import time
 import polars as pl
+from typing import Union
 from tqdm import tqdm
 from dataset.feature.feature import *
 from dataset.feature.feature_definer import FEATURE_DEF_PATH
+from dataset.feature.definition_store import load_definitions
 from dataset.feature.feature import *
-from dataset.feature.util import optimize_dataframe
+from dataset.feature.util import DtypePlanStore
+from dataset.feature.compiler import ExprCompiler
+from dataset.feature.feature_cache import FeatureCache
+from dataset.feature.segmented import SegmentedEngine
 
 from dataset.datainfo import RawInfo, RawReader, DATA_PATH
 from dataset.const import TOPICS, Topic, KEY_COL, DATE_COL, TARGET_COL
 
+ENGINES = ('expr', 'sql', 'segmented')
+
+PMTS_YEAR_COLS = ['min_pmts_year_1139T507T__D', 'max_pmts_year_1139T507T__D']
+
+
+def _clean_year_string(col: str) -> pl.Expr:
+    # same cleanup the sql path applies to the pmts_year columns
+    return (
+        pl.when(pl.col(col) == '-01-01')
+        .then(None)
+        .otherwise(pl.col(col).str.replace_all('.0', '', literal=True))
+        .alias(col)
+    )
+
 
 class FeatureLoader:
-    def __init__(self, topic: Topic, type: str, conf: dict = None):
+    """
+    Load feature data of a topic.
+
+    With lazy=True the prep and base files are scanned instead of read, and each
+    batch is executed with the streaming engine. Only the columns referenced by
+    the batch are read, so memory stays bounded at the cost of a scan per batch.
+
+    With projection=True nothing is loaded up front; every batch reads only the
+    columns its features reference from the prep parquet.
+
+    With a FeatureCache, columns computed before from the same definition and
+    input files are read back instead of recomputed.
+    """
+
+    def __init__(
+        self,
+        topic: Topic,
+        type: str,
+        conf: dict = None,
+        lazy: bool = False,
+        projection: bool = False,
+        cache: FeatureCache = None,
+    ):
         self.topic = topic
         self.type = type
-        self.data = self._load_data(type_=type, stage='prep', rawinfo=RawInfo(conf))
+        self.lazy = lazy
+        self.projection = projection
+        self.cache = cache
+        self.rawinfo = RawInfo(conf)
+        self.reader = RawReader('lazy') if lazy else RawReader('polars')
+        self.data = None
+        self.dtypes = DtypePlanStore(
+            RawInfo.get_dtype_plan_path(f'{topic.name}_features', topic.depth), type
+        )
+        if not projection:
+            self.data = self._load_data(
+                type_=type, stage='prep', rawinfo=self.rawinfo, reader=self.reader
+            )
 
     def _load_data(
         self,
@@ -25,35 +78,99 @@ class FeatureLoader:
         type_='train',
         stage='prep',
         reader=RawReader('polars'),
-    ) -> pl.DataFrame:
+        columns: List[str] = None,
+    ) -> Union[pl.DataFrame, pl.LazyFrame]:
         base_columns = [*KEY_COL, *DATE_COL]
         if type_ == 'train':
             base_columns += TARGET_COL
+        data_columns = None
+        if columns is not None:
+            available = rawinfo.get_metadata(
+                self.topic.name, depth=self.topic.depth, type_=type_, stage='prep'
+            )[0].columns
+            data_columns = [
+                c for c in dict.fromkeys([*KEY_COL, *columns])
+                if c in available and c not in base_columns[len(KEY_COL):]
+            ]
         data = rawinfo.read_raw(
             self.topic.name,
             depth=self.topic.depth,
             reader=reader,
             type_=type_,
             stage=stage,
+            columns=data_columns,
         )
-        base = rawinfo.read_raw('base', reader=reader, type_=type_)
-        base = base.with_columns(pl.col(KEY_COL).cast(pl.Int32))
+        base = rawinfo.read_raw('base', reader=reader, type_=type_, columns=base_columns)
+        # prep files are sorted by case_id, sort base too so the join can merge
+        base = base.with_columns(pl.col(KEY_COL).cast(pl.Int32)).sort(KEY_COL)
         return data.join(base.select(base_columns), on=KEY_COL, how='inner')
 
     def load_features(self, feature_names: List[str] = None) -> List[Feature]:
-        if not os.path.exists(FEATURE_DEF_PATH / f'{self.topic.name}.json'):
-            raise FileNotFoundError(
-                f'Feature definition for {self.topic.name} not found.'
-            )
+        return load_definitions(FEATURE_DEF_PATH, self.topic.name, feature_names)
+
+    def _batch_data(self, features) -> Union[pl.DataFrame, pl.LazyFrame]:
+        if not self.projection:
+            return self.data
+        columns = ExprCompiler().source_columns(features)
+        return self._load_data(
+            self.rawinfo, type_=self.type, reader=self.reader, columns=columns
+        )
+
+    def _fingerprint(self) -> str:
+        paths = [self.rawinfo.get_prep_path(self.topic.name, self.topic.depth, self.type)]
+        paths += [
+            rf.get_path(self.rawinfo.data_dir_path)
+            for rf in self.rawinfo.get_files('base', type_=self.type)
+        ]
+        return FeatureCache.fingerprint(paths)
 
-        with open(FEATURE_DEF_PATH / f'{self.topic.name}.json', 'r') as f:
-            features = json.load(f)
+    def _query(self, features, engine, group_cols, verbose=False) -> pl.DataFrame:
+        data = self._batch_data(features)
+        if engine == 'sql':
+            return self.query_sql(data, features, verbose=verbose)
+        if engine == 'segmented':
+            return self.query_segmented(data, features, group_cols, verbose=verbose)
+        return self.query_expr(data, features, group_cols, verbose=verbose)
+
+    def load_feature_data(self, features, verbose=False, engine='expr') -> pl.DataFrame:
+        if engine not in ENGINES:
+            raise ValueError(f"engine should be one of {ENGINES}. Not {engine}.")
+        if engine != 'sql' and self.type != 'train':
+            group_cols = [*KEY_COL]
+        else:
+            group_cols = [*KEY_COL, *TARGET_COL]
+
+        if self.cache is None:
+            temp = self._query(features, engine, group_cols, verbose=verbose)
+            return self._optimize(temp)
+
+        fingerprint = self._fingerprint()
+        cached, missing = self.cache.get(features, fingerprint, engine)
+        if verbose:
+            print(f'[*] {len(cached)} cached, {len(missing)} to compute')
+        frames = []
+        if len(missing) > 0:
+            temp = self._query(missing, engine, group_cols, verbose=verbose)
+            self.cache.put(missing, fingerprint, temp, group_cols, engine)
+            frames.append(temp.sort(KEY_COL))
+        frames += [column.sort(KEY_COL) for column in cached.values()]
+        temp = pl.concat(
+            [frames[0]] + [frame.drop(group_cols) for frame in frames[1:]], how='horizontal'
+        )
+        temp = temp.select([*group_cols, *[feat.name for feat in features]])
+        return self._optimize(temp)
 
-        if feature_names is None:
-            return [Feature.from_dict(feature) for feature in features.values()]
-        return [Feature.from_dict(features[feature_name]) for feature_name in feature_names]
+    def _optimize(self, temp: pl.DataFrame) -> pl.DataFrame:
+        """
+        Feature dtypes are planned on train and stored per topic, see DtypePlanStore.
+        """
+        return self.dtypes.apply(temp)
 
-    def load_feature_data(self, features, verbose=False) -> pl.DataFrame:
+    @staticmethod
+    def query_sql(frame: Union[pl.DataFrame, pl.LazyFrame], features, group_cols: List[str] = None, verbose=False) -> pl.DataFrame:
+        if group_cols is None:
+            group_cols = [*KEY_COL, *TARGET_COL]
+        group_query = ', '.join(f'frame.{col}' for col in group_cols)
         query = [
             f'cast({feat.query} as {feat.agg.data_type}) as {feat.name}'
             for feat in features
@@ -61,12 +178,12 @@ class FeatureLoader:
         if verbose:
             for q in query:
                 print(f'[*] Query: {q}')
-        temp = pl.SQLContext(frame=self.data).execute(
+        return pl.SQLContext(frame=frame).execute(
             f"""
-            SELECT frame.case_id, frame.target
+            SELECT {group_query}
                 , {', '.join(query)}
             from frame
-            group by frame.case_id, frame.target
+            group by {group_query}
             """.replace(
                 'float32', 'float'
             )
@@ -80,10 +197,79 @@ class FeatureLoader:
             ),
             eager=True,
         )
-        temp = optimize_dataframe(temp)
-        return temp
 
-    def load_feature_data_batch(self, features, batch_size, verbose=False, skip=0):
+    @staticmethod
+    def query_expr(
+        frame: Union[pl.DataFrame, pl.LazyFrame], features, group_cols: List[str], verbose=False
+    ) -> pl.DataFrame:
+        """
+        Build features with native polars expressions.
+        Each distinct filter condition of the batch is materialized once as a
+        boolean mask column which every aggregation under it references.
+        Features the compiler does not support fall back to the SQL path.
+        A LazyFrame is executed with the streaming engine.
+        """
+        schema = frame.collect_schema() if isinstance(frame, pl.LazyFrame) else frame.schema
+        query = FeatureLoader.compile_query(schema, features, group_cols, verbose=verbose)
+        return query.execute(frame, verbose=verbose)
+
+    @staticmethod
+    def query_segmented(
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        features,
+        group_cols: List[str],
+        backend: str = 'auto',
+        verbose=False,
+    ) -> pl.DataFrame:
+        """
+        Build features as segmented reductions over the frame sorted by
+        group_cols, see SegmentedEngine. Features it does not handle fall back
+        to the expression path.
+        """
+        schema = frame.collect_schema() if isinstance(frame, pl.LazyFrame) else frame.schema
+        frame = frame.with_columns([
+            _clean_year_string(col) for col in PMTS_YEAR_COLS if col in schema
+        ])
+        temp, unsupported = SegmentedEngine(backend).query(frame, features, group_cols)
+        if len(unsupported) > 0:
+            if verbose:
+                print(f'[*] {len(unsupported)} features fall back to expr')
+            fallback = FeatureLoader.query_expr(frame, unsupported, group_cols, verbose=verbose)
+            temp = temp.join(fallback, on=group_cols, how='left')
+        return temp.select([*group_cols, *[feat.name for feat in features]])
+
+    @staticmethod
+    def compile_query(
+        schema, features, group_cols: List[str], verbose=False, fuse=True
+    ) -> 'CompiledQuery':
+        """
+        Compile features once for frames of the given schema, e.g. to run the
+        same features over many small frames. With fuse=True, numeric
+        aggregations of the same value and filters share one set of partials.
+        """
+        compiler = ExprCompiler(schema)
+        mask_exprs, masks = compiler.compile_masks(features)
+        values, partials, derived, rest = [], [], [], features
+        if fuse:
+            values, partials, derived, rest = compiler.fuse_features(features, masks)
+        exprs, unsupported = compiler.compile_features(rest, masks)
+        if verbose:
+            print(f'[*] {len(masks)} distinct masks for {len(features)} features')
+            print(f'[*] {len(derived)} features fused into {len(partials)} partials')
+            for expr in [*partials, *derived, *exprs]:
+                print(f'[*] Expr: {expr}')
+        if verbose and len(unsupported) > 0:
+            print(f'[*] {len(unsupported)} features fall back to sql')
+
+        columns = [
+            c for c in dict.fromkeys([*group_cols, *compiler.source_columns(features)])
+            if c in schema
+        ]
+        return CompiledQuery(
+            features, group_cols, columns, mask_exprs, values, [*partials, *exprs], derived, unsupported
+        )
+
+    def load_feature_data_batch(self, features, batch_size, verbose=False, skip=0, engine='expr'):
         """
         Load feature data in batch
         """
@@ -93,7 +279,7 @@ class FeatureLoader:
                 yield None
             else:
                 yield self.load_feature_data(
-                    features[index : index + batch_size], verbose=verbose
+                    features[index : index + batch_size], verbose=verbose, engine=engine
                 )
         print(f'[*] Elapsed time: {time.time() - start_time:.4f} sec')
 
@@ -106,3 +292,42 @@ class FeatureLoader:
     #     else:
     #         feature_names += [KEY_COL, TARGET_COL]
     #     return df.select([c for c in df.columns if c in feature_names])
+
+
+class CompiledQuery:
+    """
+    Features compiled by FeatureLoader.compile_query, executable on any frame
+    with the schema they were compiled for.
+    """
+
+    def __init__(
+        self, features, group_cols, columns, mask_exprs, value_exprs, exprs, derived, unsupported
+    ):
+        self.features = features
+        self.group_cols = group_cols
+        self.columns = columns
+        self.mask_exprs = mask_exprs
+        self.value_exprs = value_exprs
+        self.exprs = exprs
+        self.derived = derived
+        self.unsupported = unsupported
+
+    def execute(self, frame: Union[pl.DataFrame, pl.LazyFrame], verbose=False) -> pl.DataFrame:
+        # a DataFrame runs eagerly, which skips query planning on small frames,
+        # so empty steps are left out rather than run as no-op queries
+        temp = frame.select(self.columns)
+        cleaned = [_clean_year_string(col) for col in PMTS_YEAR_COLS if col in self.columns]
+        for exprs in [cleaned, self.mask_exprs, self.value_exprs]:
+            if len(exprs) > 0:
+                temp = temp.with_columns(exprs)
+        temp = temp.group_by(self.group_cols).agg(self.exprs)
+        if len(self.derived) > 0:
+            temp = temp.with_columns(self.derived)
+        if isinstance(temp, pl.LazyFrame):
+            temp = temp.collect(engine='streaming')
+        if len(self.unsupported) > 0:
+            fallback = FeatureLoader.query_sql(
+                frame, self.unsupported, self.group_cols, verbose=verbose
+            )
+            temp = temp.join(fallback, on=self.group_cols, how='left')
+        return temp.select([*self.group_cols, *[feat.name for feat in self.features]])
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+import polars as pl
+
+from dataset.feature.feature import Feature
+from dataset.datainfo import PREP_FORMATS, read_frame
+from dataset.const import KEY_COL
+
+
+class FeatureManifest:
+    """
+    Record of which features are materialized in which output file.
+
+    The manifest lives next to the feature files as {prefix}_manifest.json and
+    maps every batch file to the features it holds, together with a hash of
+    each feature definition. Syncing against a new definition list computes
+    only the added (or redefined) features into new batch files, forgets the
+    removed ones and deletes files nothing refers to anymore. Existing batch
+    files are never rewritten.
+
+    Args:
+        output_dir (Path): directory of the feature files.
+        prefix (str): file name prefix, e.g. 'train_applprev_features'.
+        format (str): 'parquet' or 'ipc' for new batch files.
+    """
+
+    def __init__(self, output_dir: Path, prefix: str, format: str = 'parquet'):
+        if format not in PREP_FORMATS:
+            raise ValueError(f'format should be one of {list(PREP_FORMATS)}. Not {format}.')
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.format = format
+        self.path = self.output_dir / f'{prefix}_manifest.json'
+        self.files: Dict[str, Dict[str, str]] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.files = json.load(f)['files']
+
+    @staticmethod
+    def definition_hash(feature: Feature) -> str:
+        return hashlib.sha1(json.dumps(feature.to_dict(), sort_keys=True).encode()).hexdigest()
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        temp_path = self.path.with_suffix('.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump({'prefix': self.prefix, 'files': self.files}, f)
+        os.replace(temp_path, self.path)
+
+    def materialized(self) -> Dict[str, str]:
+        """
+        Feature name to the file holding it.
+        """
+        return {
+            name: file_name
+            for file_name, features in self.files.items()
+            for name in features
+        }
+
+    def plan(self, features: List[Feature]) -> Tuple[List[Feature], List[str]]:
+        """
+        Features to compute and feature names to drop to match the definitions.
+        """
+        hashes = {
+            name: definition_hash
+            for features_in_file in self.files.values()
+            for name, definition_hash in features_in_file.items()
+        }
+        wanted = {feature.name: self.definition_hash(feature) for feature in features}
+        added = [
+            feature for feature in features
+            if hashes.get(feature.name) != wanted[feature.name]
+        ]
+        removed = [
+            name for name, definition_hash in hashes.items()
+            if wanted.get(name) != definition_hash
+        ]
+        return added, removed
+
+    def next_index(self) -> int:
+        indices = [
+            int(matched.group(1))
+            for file_name in self.files
+            if (matched := re.search(r'_(\d+)\.(parquet|arrow)$', file_name))
+        ]
+        return max(indices) + 1 if len(indices) > 0 else 0
+
+    def add(self, file_name: Union[str, Path], features: List[Feature]):
+        self.files[Path(file_name).name] = {
+            feature.name: self.definition_hash(feature) for feature in features
+        }
+
+    def remove(self, names: List[str]):
+        names = set(names)
+        for file_name in list(self.files):
+            self.files[file_name] = {
+                name: definition_hash
+                for name, definition_hash in self.files[file_name].items()
+                if name not in names
+            }
+            if len(self.files[file_name]) == 0:
+                del self.files[file_name]
+                if (self.output_dir / file_name).exists():
+                    os.remove(self.output_dir / file_name)
+
+    def sync(
+        self,
+        features: List[Feature],
+        builder,
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        group_cols: List[str],
+        batch_size: int,
+    ) -> Tuple[List[Feature], List[str]]:
+        """
+        Bring the materialized files in line with features using builder
+        (a ShardedFeatureBuilder). Returns the added features and removed names.
+        """
+        added, removed = self.plan(features)
+        print(f'[*] {len(added)} features to add, {len(removed)} to remove')
+        self.remove(removed)
+        self.save()
+        if len(added) == 0:
+            return added, removed
+
+        start_index = self.next_index()
+        paths = builder.build(
+            frame,
+            added,
+            group_cols,
+            batch_size,
+            self.output_dir,
+            self.prefix,
+            start_index=start_index,
+            format=self.format,
+        )
+        for path, index in zip(paths, range(0, len(added), batch_size)):
+            self.add(path, added[index : index + batch_size])
+        self.save()
+        return added, removed
+
+    def read(self, names: List[str] = None) -> pl.DataFrame:
+        """
+        Read materialized features (all of them by default) joined on KEY_COL.
+        """
+        materialized = self.materialized()
+        names = list(materialized) if names is None else names
+        by_file: Dict[str, List[str]] = {}
+        for name in names:
+            if name not in materialized:
+                raise KeyError(f'{name} is not materialized in {self.output_dir}.')
+            by_file.setdefault(materialized[name], []).append(name)
+
+        data = None
+        for file_name, columns in by_file.items():
+            temp = read_frame(self.output_dir / file_name, columns=[*KEY_COL, *columns])
+            data = temp if data is None else data.join(temp, on=KEY_COL, how='full', coalesce=True)
+        return data.select([*KEY_COL, *names])
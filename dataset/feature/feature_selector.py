@@ -0,0 +1,302 @@
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+import polars as pl
+from lightgbm import LGBMClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+
+from dataset.datainfo import DATA_PATH, PREP_FORMATS, read_frame, write_frame
+from dataset.feature.feature import Feature
+from dataset.feature.feature_loader import FeatureLoader
+from dataset.feature.prescreen import FeatureScreener
+from dataset.const import KEY_COL, TARGET_COL
+
+
+SELECT_PATH = DATA_PATH / 'feature_selection'
+
+
+def train_model(X: pd.DataFrame, y: pd.Series, n_jobs: int = -1):
+    cat_indicis = [i for i, c in enumerate(X.columns) if X[c].dtype == 'O']
+    X = X.astype({c: 'category' for c in X.columns if X[c].dtype == 'O'})
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y.to_numpy().ravel(), test_size=0.2, random_state=42
+    )
+    model = LGBMClassifier(
+        **{
+            'n_estimators': 200,
+            'max_depth': 3,
+            'subsample': 0.7,
+            'learning_rate': 0.01,
+            'verbose': -1,
+            'random_state': 42,
+            'is_unbalance': True,
+            'importance_type': 'gain',
+            'n_jobs': n_jobs,
+        }
+    )
+    model.fit(
+        X_train,
+        y_train,
+        categorical_feature=cat_indicis,
+    )
+    train_auroc = roc_auc_score(y_train, model.predict_proba(X_train)[:, 1])
+    test_auroc = roc_auc_score(y_test, model.predict_proba(X_test)[:, 1])
+    print(f'Train AUC: {train_auroc:.4f}, Test AUC: {test_auroc:.4f}')
+    del X_train, X_test, y_train, y_test
+    return model, {'train_auc': train_auroc, 'test_auc': test_auroc}
+
+
+def select_features(df: pl.DataFrame, n_jobs: int = -1) -> Tuple[List[str], Dict[str, float]]:
+    """
+    Features of df with a non zero gain in a small LightGBM model, and its AUCs.
+    """
+    y = df.select(TARGET_COL)
+    X = df.drop([*KEY_COL, *TARGET_COL, 'case_id_right', 'case_id_right2'], strict=False).to_pandas()
+    model, scores = train_model(X, y, n_jobs=n_jobs)
+    features = X.columns[model.feature_importances_ > 0].to_list()
+    del X, y
+    return features, scores
+
+
+@dataclass
+class SelectionJob:
+    """
+    Features of a topic to select from, batch_size at a time or in the
+    batches of feature names given. Batches in done are neither built nor
+    trained.
+    """
+    name: str
+    loader: FeatureLoader
+    features: List[Feature]
+    done: set = field(default_factory=set)
+    batches: List[List[str]] = None
+
+
+@dataclass
+class BatchResult:
+    name: str
+    index: int
+    selected: List[str]
+    build_sec: float
+    train_sec: float
+    n_features: int = 0
+    scores: Dict[str, float] = field(default_factory=dict)
+    # features screened out before training, with the reason
+    dropped: Dict[str, str] = field(default_factory=dict)
+    # column digests the screener first saw in this batch, to the feature
+    digests: Dict[str, str] = field(default_factory=dict)
+
+
+class SelectionScheduler:
+    """
+    Pipelined feature selection over many topics.
+
+    Every (topic, batch) goes through two stages: build, where the feature
+    data of the batch is computed and written to the shared store as a memory
+    mapped Arrow IPC file, and train, where select reads it back and keeps the
+    useful features. Stages run in separate thread pools (polars and
+    LightGBM both release the GIL), so batch i + 1 of a topic is built while
+    batch i trains, and builds of other topics fill the cores a single topic
+    leaves idle.
+
+    Builds of a topic run one at a time, since they share its loader and dtype
+    plan, and at most prefetch built batches of a topic wait for training.
+    A build is only started while the estimated size of the batches in
+    flight (rows x features x 8 bytes, rows from the catalog row count of
+    base) stays under memory_budget_mb, so the pipeline never holds more
+    than the budget whatever the number of topics.
+
+    With a FeatureScreener, each built batch is screened before it is
+    written, so dropped features are never stored nor trained on.
+
+    Args:
+        select (Callable): select(frame, n_jobs) -> names of the features kept and scores.
+        batch_size (int): features per batch.
+        store_dir (Path): shared store of built batches.
+        n_threads (int): CPU budget. Defaults to the cpu count.
+        n_builders (int): batches built at once.
+        n_trainers (int): models trained at once, each with n_threads // n_trainers threads.
+        prefetch (int): built batches of a topic waiting for training.
+        memory_budget_mb (int): estimated size of the batches in flight. None for no limit.
+        screener (FeatureScreener): filters applied to every batch before training.
+    """
+
+    def __init__(
+        self,
+        select: Callable[[pl.DataFrame, int], Tuple[List[str], Dict[str, float]]] = select_features,
+        batch_size: int = 1000,
+        store_dir: Path = None,
+        n_threads: int = None,
+        n_builders: int = 2,
+        n_trainers: int = 1,
+        prefetch: int = 1,
+        memory_budget_mb: int = None,
+        screener: FeatureScreener = None,
+    ):
+        self.select = select
+        self.batch_size = batch_size
+        self.store_dir = Path(store_dir) if store_dir is not None else SELECT_PATH / 'store'
+        self.n_threads = n_threads if n_threads is not None else os.cpu_count() or 1
+        self.n_builders = n_builders
+        self.n_trainers = n_trainers
+        self.prefetch = prefetch
+        self.memory_budget = memory_budget_mb * 1024 ** 2 if memory_budget_mb is not None else None
+        self.screener = screener
+        self.results: List[BatchResult] = []
+        self.elapsed = 0.0
+
+    def batches(self, job: SelectionJob) -> List[Tuple[int, List[Feature]]]:
+        if job.batches is not None:
+            features = {feature.name: feature for feature in job.features}
+            return [
+                (i, [features[name] for name in names])
+                for i, names in enumerate(job.batches)
+                if i not in job.done
+            ]
+        return [
+            (i, job.features[index : index + self.batch_size])
+            for i, index in enumerate(range(0, len(job.features), self.batch_size))
+            if i not in job.done
+        ]
+
+    @staticmethod
+    def estimate_bytes(job: SelectionJob, features: List[Feature]) -> int:
+        rows = job.loader.rawinfo.num_rows('base', type_=job.loader.type)
+        return rows * (len(features) + len(KEY_COL) + len(TARGET_COL)) * 8
+
+    def _build(
+        self, job: SelectionJob, index: int, features: List[Feature]
+    ) -> Tuple[Path, Dict[str, str], Dict[str, str], float]:
+        start_time = time.perf_counter()
+        path = self.store_dir / f'{job.name}_{index}{PREP_FORMATS["ipc"]}'
+        frame = job.loader.load_feature_data(features)
+        dropped, digests = {}, {}
+        if self.screener is not None:
+            # builds of a topic run one at a time in batch order, as the screener expects
+            frame, dropped = self.screener.screen(job.name, frame)
+            digests = self.screener.added[job.name]
+        write_frame(frame, path)
+        return path, dropped, digests, time.perf_counter() - start_time
+
+    def _train(self, path: Path) -> Tuple[List[str], Dict[str, float], float]:
+        start_time = time.perf_counter()
+        frame = read_frame(path)
+        selected, scores = [], {}
+        if any(c not in [*KEY_COL, *TARGET_COL] for c in frame.columns):
+            # a batch can be screened out entirely
+            selected, scores = self.select(frame, max(1, self.n_threads // self.n_trainers))
+        del frame
+        os.remove(path)
+        return selected, scores, time.perf_counter() - start_time
+
+    def run(
+        self,
+        jobs: List[SelectionJob],
+        on_batch: Callable[[BatchResult], None] = None,
+    ) -> Dict[str, List[str]]:
+        """
+        Selected features of every job, in feature order. on_batch is called
+        in the scheduling thread as soon as a batch is trained.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        pending = {job.name: self.batches(job) for job in jobs}
+        jobs_by_name = {job.name: job for job in jobs}
+        selected: Dict[str, Dict[int, List[str]]] = {job.name: {} for job in jobs}
+        building: Dict[Future, Tuple[str, int, int, int]] = {}
+        training: Dict[Future, Tuple[str, int, int, int, Dict[str, str], Dict[str, str], float]] = {}
+        built: Dict[str, List[Tuple[int, Path, int, int, Dict[str, str], Dict[str, str], float]]] = {
+            job.name: [] for job in jobs
+        }
+        in_flight = 0
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(self.n_builders) as builders, ThreadPoolExecutor(self.n_trainers) as trainers:
+            while building or training or any(pending.values()) or any(built.values()):
+                # trainers take built batches in topic order, oldest first
+                for name in pending:
+                    while built[name] and len(training) < self.n_trainers:
+                        index, path, size, n_features, dropped, digests, build_sec = built[name].pop(0)
+                        training[trainers.submit(self._train, path)] = (
+                            name, index, size, n_features, dropped, digests, build_sec
+                        )
+
+                # builders start the next batch of the first topics with room in their pipeline
+                topics_building = {name for name, *_ in building.values()}
+                for name, batches in pending.items():
+                    if len(building) >= self.n_builders:
+                        break
+                    waiting = len(built[name]) + sum(n == name for n, *_ in training.values())
+                    if not batches or name in topics_building or waiting > self.prefetch:
+                        continue
+                    size = 0
+                    if self.memory_budget is not None:
+                        size = self.estimate_bytes(jobs_by_name[name], batches[0][1])
+                        if in_flight > 0 and in_flight + size > self.memory_budget:
+                            break
+                    index, features = batches.pop(0)
+                    building[builders.submit(self._build, jobs_by_name[name], index, features)] = (
+                        name, index, size, len(features)
+                    )
+                    topics_building.add(name)
+                    in_flight += size
+
+                done, _ = wait([*building, *training], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in building:
+                        name, index, size, n_features = building.pop(future)
+                        path, dropped, digests, build_sec = future.result()
+                        built[name].append((index, path, size, n_features, dropped, digests, build_sec))
+                    else:
+                        name, index, size, n_features, dropped, digests, build_sec = training.pop(future)
+                        names, scores, train_sec = future.result()
+                        in_flight -= size
+                        selected[name][index] = names
+                        result = BatchResult(
+                            name, index, names, build_sec, train_sec, n_features, scores, dropped, digests
+                        )
+                        self.results.append(result)
+                        if on_batch is not None:
+                            on_batch(result)
+        self.elapsed = time.perf_counter() - start_time
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        return {
+            name: [feature for index in sorted(batches) for feature in batches[index]]
+            for name, batches in selected.items()
+        }
+
+    def report(self) -> str:
+        build_sec = sum(result.build_sec for result in self.results)
+        train_sec = sum(result.train_sec for result in self.results)
+        serial = build_sec + train_sec
+        speedup = serial / self.elapsed if self.elapsed > 0 else 0.0
+        return (
+            f'[*] Selection: {len(self.results)} batches in {self.elapsed:.2f}s, '
+            f'build {build_sec:.2f}s + train {train_sec:.2f}s of stage time '
+            f'({speedup:.2f}x over running them back to back)'
+        ) + (f'\n{self.screening_report()}' if self.screener is not None else '')
+
+    def screening_report(self) -> str:
+        """
+        Training time saved by screening, from a linear fit of the time of
+        each model on its number of features.
+        """
+        trained = np.array([r.n_features - len(r.dropped) for r in self.results if r.train_sec > 0])
+        train_sec = np.array([r.train_sec for r in self.results if r.train_sec > 0])
+        dropped = sum(len(r.dropped) for r in self.results)
+        if len(set(trained)) > 1:
+            per_feature = max(np.polyfit(trained, train_sec, 1)[0], 0.0)
+        else:
+            # a single batch size, no fixed cost to tell apart
+            per_feature = train_sec.sum() / max(trained.sum(), 1)
+        return (
+            f'{self.screener.report()}\n'
+            f'[*] Screening saved about {per_feature * dropped:.2f}s of training '
+            f'for {self.screener.elapsed:.2f}s of screening'
+        )
@@ -1,19 +1,29 @@
 import gc
+import multiprocessing
 import shutil
 import polars as pl
 import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Tuple, Union
 
 from dataset.datainfo import RawInfo, RawReader, DATA_PATH
 from dataset.feature.feature import *
-from dataset.feature.util import optimize_dataframe
-from dataset.const import TOPICS, DEPTH_2_TO_1_QUERY, CB_A_PREPREP_QUERY
+from dataset.feature.util import (
+    optimize_dataframe, dtype_plan, apply_dtype_plan, save_dtype_plan, load_dtype_plan, limit_memory
+)
+from dataset.const import TOPICS, DEPTH_2_TO_1_QUERY, DEPTH_2_PREP_QUERY
 
 
 class Preprocessor:
 
-    def __init__(self, type_: str, conf: dict = None):
+    def __init__(
+        self, type_: str, conf: dict = None, n_workers: int = None, memory_limit_mb: int = None
+    ):
         self.raw_info = RawInfo(conf)
         self.type_ = type_
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.memory_limit_mb = memory_limit_mb
 
     def preprocess(self):
         for topic in TOPICS:
@@ -26,83 +36,124 @@ class Preprocessor:
                 pass
             elif topic.depth == 2 and topic.name in DEPTH_2_TO_1_QUERY:
                 print(f'[+] Preprocessing {topic.name}, depth={topic.depth}')
-                query = DEPTH_2_TO_1_QUERY[topic.name]
-                if topic.name == 'credit_bureau_a':
-                    self._preprocess_cb_a(topic.name, query)
-                else:
-                    self._preprocess_each(topic.name, query)
+                self._preprocess_depth2(topic.name, DEPTH_2_TO_1_QUERY[topic.name])
             elif topic.depth == 2 and topic.name not in DEPTH_2_TO_1_QUERY:
                 raise ValueError(f'No query for {topic.name} in DEPTH_2_TO_1_QUERY but it is depth=2 topic')
+        print(self.raw_info.ingest_report())
+
+    def _dtype_plan(self, data: Union[pl.DataFrame, pl.LazyFrame], topic: str, depth: int) -> dict:
+        # dtypes are planned once on train and reused as is for test,
+        # so both get the same prep schema without another stats pass
+        path = self.raw_info.get_dtype_plan_path(topic, depth)
+        if self.type_ == 'train':
+            plan = dtype_plan(data)
+            save_dtype_plan(plan, path)
+            return plan
+        if not path.exists():
+            raise FileNotFoundError(f'{path} does not exist. Preprocess train first.')
+        return load_dtype_plan(path)
+
+    def _optimize(
+        self, data: Union[pl.DataFrame, pl.LazyFrame], topic: str, depth: int
+    ) -> Union[pl.DataFrame, pl.LazyFrame]:
+        # a train plan is made from data, test values are checked against it
+        return apply_dtype_plan(data, self._dtype_plan(data, topic, depth), check=self.type_ != 'train')
 
     def _memory_opt(self, topic: str, depth: int):
-        data = self.raw_info.read_raw(topic, depth=depth, reader=RawReader('polars'), type_=self.type_)
-        data = optimize_dataframe(data)
+        if self.type_ == 'train':
+            data = self.raw_info.read_raw(topic, depth=depth, reader=RawReader('polars'), type_=self.type_)
+            data = self._optimize(data, topic, depth)
+        else:
+            data = self.raw_info.read_raw(
+                topic,
+                depth=depth,
+                reader=RawReader('polars'),
+                type_=self.type_,
+                dtypes=self._dtype_plan(None, topic, depth),
+            )
         self.raw_info.save_as_prep(data, topic, depth=depth, type_=self.type_)
 
-    def _join_depth2_0(self, depth1, depth2):
-        depth2 = depth2.filter(pl.col('num_group2') == 0).drop('num_group2')
-        depth1 = depth1.join(depth2, on=['case_id', 'num_group1'], how='left')
-        return depth1
+    def _preprocess_depth2(self, topic: str, query: str):
+        """
+        Aggregate depth 2 into depth 1 one raw file at a time in a process pool.
+
+        Each worker writes the aggregated part and the num_group2 == 0 part of
+        its file; depth 1 is then joined to both with lazy scans and streamed
+        into the prep file, so peak memory is bounded by a single raw file.
+        A (case_id, num_group1) group is assumed not to span raw files.
+        """
+        temp_path = DATA_PATH / 'parquet_preps' / self.type_ / f'{topic}_temp'
+        os.makedirs(temp_path / 'agg', exist_ok=True)
+        os.makedirs(temp_path / 'depth2_0', exist_ok=True)
+
+        raw_files = list(enumerate(self.raw_info.get_files(topic, depth=2, type_=self.type_)))
+        if self.raw_info.format == 'parquet':
+            # largest files first from the cached footers, so a long one does not start last
+            metadata = self.raw_info.get_metadata(topic, depth=2, type_=self.type_)
+            raw_files = sorted(raw_files, key=lambda item: -metadata[item[0]].num_rows)
+        with ProcessPoolExecutor(
+            max_workers=min(self.n_workers, len(raw_files)),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=limit_memory,
+            initargs=(self.memory_limit_mb,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _aggregate_depth2,
+                    rf.get_path(self.raw_info.data_dir_path),
+                    topic,
+                    query,
+                    temp_path / 'agg' / f"{self.type_}_{topic}_1_temp_{i}.parquet",
+                    temp_path / 'depth2_0' / f"{self.type_}_{topic}_1_temp_{i}.parquet",
+                )
+                for i, rf in raw_files
+            ]
+            for future in futures:
+                future.result()
+
+        depth1 = self.raw_info.read_raw(topic, depth=1, reader=RawReader('lazy'), type_=self.type_)
+        for part in ['agg', 'depth2_0']:
+            # parts are downcast independently, so relax them to a common schema
+            depth2_temp = pl.concat(
+                [pl.scan_parquet(file) for file in sorted((temp_path / part).glob('*.parquet'))],
+                how='vertical_relaxed',
+            )
+            depth1 = depth1.join(depth2_temp, on=['case_id', 'num_group1'], how='left')
+        depth1 = self._optimize(depth1, topic, depth=1)
+        self.raw_info.save_as_prep(depth1, topic, depth=1, type_=self.type_)
 
-    def _preprocess_each(self, topic: str, query: str):
-        depth2 = self.raw_info.read_raw(topic, depth=2, reader=RawReader('polars'), type_=self.type_)
-        depth1 = self.raw_info.read_raw(topic, depth=1, reader=RawReader('polars'), type_=self.type_)
-        temp = pl.SQLContext(data=depth2).execute(query, eager=True)
-        depth1 = depth1.join(temp, on=['case_id', 'num_group1'], how='left')
-        depth1 = self._join_depth2_0(depth1, depth2)
+        # remove temp files
+        shutil.rmtree(temp_path)
 
-        depth1 = optimize_dataframe(depth1)
-        self.raw_info.save_as_prep(depth1, topic, depth=1, type_=self.type_)
 
-    def _preprocess_cb_a(self, topic: str, query: str):
-        temp_path = DATA_PATH / 'parquet_preps' / self.type_
-        os.makedirs(temp_path, exist_ok=True)
-        os.makedirs(temp_path/'agg', exist_ok=True)
-        os.makedirs(temp_path/'depth2_0', exist_ok=True)
+def aggregate_depth2(depth2: pl.DataFrame, topic: str, query: str) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Aggregated depth 2 rows and the num_group2 == 0 rows of a depth 2 frame,
+    both keyed by (case_id, num_group1).
+    """
+    if topic in DEPTH_2_PREP_QUERY:
+        depth2 = optimize_dataframe(depth2)
 
-        iter = self.raw_info.read_raw_iter(topic, depth=2, reader=RawReader('polars'), type_=self.type_)
-        for i, depth2 in enumerate(iter):
-            depth2 = optimize_dataframe(depth2)
+    depth2_0 = depth2.filter(pl.col('num_group2') == 0).drop('num_group2')
 
-            depth2_0 = depth2.filter(pl.col('num_group2') == 0).drop('num_group2')
-            temp_file = temp_path / 'depth2_0'/ f"{self.type_}_{topic}_1_temp_{i}.parquet"
-            depth2_0.write_parquet(temp_file)
-            del depth2_0
+    if topic in DEPTH_2_PREP_QUERY:
+        depth2 = pl.SQLContext(data=depth2).execute(DEPTH_2_PREP_QUERY[topic], eager=True)
+        depth2 = optimize_dataframe(depth2)
+    depth2 = pl.SQLContext(data=depth2).execute(query, eager=True)
+    if topic in DEPTH_2_PREP_QUERY:
+        depth2 = optimize_dataframe(depth2)
+    return depth2, depth2_0
 
-            depth2 = pl.SQLContext(data=depth2).execute(
-                CB_A_PREPREP_QUERY,
-                eager=True,
-            )
-            depth2 = optimize_dataframe(depth2)
-            depth2 = pl.SQLContext(data=depth2).execute(query, eager=True)
-            depth2 = optimize_dataframe(depth2)
-            temp_file = temp_path / 'agg' / f"{self.type_}_{topic}_1_temp_{i}.parquet"
-            depth2.write_parquet(temp_file)
-            del depth2
-            gc.collect()            
-
-        depth1 = self.raw_info.read_raw(topic, depth=1, reader=RawReader('polars'), type_=self.type_)
-        depth1 = optimize_dataframe(depth1)
-
-        files = [f for f in os.listdir(temp_path / 'agg') if f.endswith('.parquet')]
-        dfs = [pl.read_parquet(temp_path/'agg'/file) for file in files]
-        depth2_temp = pl.concat(dfs, how='vertical_relaxed')
-        depth1 = depth1.join(depth2_temp, on=['case_id', 'num_group1'], how='left')
-        del depth2_temp
-        gc.collect()
-
-        files = [f for f in os.listdir(temp_path / 'depth2_0') if f.endswith('.parquet')]
-        dfs = [pl.read_parquet(temp_path / 'depth2_0' / file) for file in files]
-        depth2_temp = pl.concat(dfs, how='vertical_relaxed')
-        depth1 = depth1.join(depth2_temp, on=['case_id', 'num_group1'], how='left')
-        del depth2_temp
-        gc.collect()
 
-        self.raw_info.save_as_prep(depth1, topic, depth=1, type_=self.type_)
+def _aggregate_depth2(
+    path: Path, topic: str, query: str, agg_path: Path, depth2_0_path: Path
+):
+    agg, depth2_0 = aggregate_depth2(RawReader('polars')(path), topic, query)
+    depth2_0.write_parquet(depth2_0_path)
+    agg.write_parquet(agg_path)
+    del agg, depth2_0
+    gc.collect()
 
-        # remove temp files
-        shutil.rmtree(temp_path / 'agg')
-        shutil.rmtree(temp_path / 'depth2_0')
 
 if __name__ == "__main__":
     prep = Preprocessor('train')
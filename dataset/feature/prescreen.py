@@ -0,0 +1,203 @@
+import hashlib
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+import polars as pl
+
+from dataset.const import KEY_COL, TARGET_COL
+
+
+SCREEN_REASONS = ('null', 'constant', 'duplicate', 'correlated', 'uninformative')
+
+
+def column_digests(frame: pl.DataFrame, columns: List[str]) -> Dict[str, str]:
+    """
+    Digest of the contents of every column. Numeric columns are hashed as
+    Float64, so a downcast copy of a column has the digest of the column.
+    Row hashes are put in case_id order first, since batches built by a
+    group by come in any order.
+    """
+    keys = [c for c in KEY_COL if c in frame.columns]
+    hashes = frame.select(
+        *keys,
+        *[
+            (pl.col(c).cast(pl.Float64) if frame.schema[c].is_numeric() else pl.col(c).cast(pl.Utf8)).hash(0)
+            for c in columns
+        ],
+    )
+    if len(keys) > 0:
+        hashes = hashes.sort(keys)
+    return {c: hashlib.blake2b(hashes[c].to_numpy().tobytes(), digest_size=16).hexdigest() for c in columns}
+
+
+def univariate_auc(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    AUC of every column of x (rows, columns) as a score of y, from average
+    ranks. Missing values rank below every value.
+    """
+    n_pos = y.sum()
+    n_neg = len(y) - n_pos
+    ranks = pl.DataFrame(np.where(np.isnan(x), -np.inf, x)).select(pl.all().rank('average')).to_numpy()
+    return (ranks[y == 1].sum(axis=0) - n_pos * (n_pos + 1) / 2) / max(n_pos * n_neg, 1)
+
+
+def information_value(frame: pl.DataFrame, columns: List[str], target: str, n_bins: int = 10) -> Dict[str, float]:
+    """
+    Information value of every column against target. Numeric columns are
+    cut into n_bins quantile bins, other columns binned by value, missing
+    values get a bin of their own.
+    """
+    bins = frame.select(
+        pl.col(target),
+        *[
+            (
+                ((pl.col(c).rank('min') - 1) * n_bins // pl.col(c).count()).cast(pl.Utf8)
+                if frame.schema[c].is_numeric()
+                else pl.col(c).cast(pl.Utf8)
+            ).fill_null('__null__').alias(c)
+            for c in columns
+        ],
+    )
+    n_pos = max(frame[target].sum(), 1)
+    n_neg = max(len(frame) - frame[target].sum(), 1)
+    result = {}
+    for c in columns:
+        counts = bins.group_by(c).agg(pl.col(target).sum().alias('pos'), pl.len().alias('n'))
+        # half a count keeps empty cells finite
+        pos = (counts['pos'].to_numpy() + 0.5) / n_pos
+        neg = (counts['n'].to_numpy() - counts['pos'].to_numpy() + 0.5) / n_neg
+        result[c] = float(((pos - neg) * np.log(pos / neg)).sum())
+    return result
+
+
+class FeatureScreener:
+    """
+    Drop features without model training: all null, constant, exact
+    duplicates (by a digest of the column contents, across every batch of a
+    topic), near duplicates (absolute Pearson correlation above
+    corr_threshold with a kept feature of the batch, in blocks of block_size
+    columns) and
+    features with both a univariate AUC within min_auc_gain of 0.5 and an
+    information value under min_iv against target.
+
+    Correlation, AUC and IV are computed on sample_rows rows. Screening is
+    stateful per topic, call it on the batches of a topic in order. The
+    digests first seen in the last batch of a topic are in added, so a
+    resumed run can seed digests with those of the batches already done.
+
+    Args:
+        corr_threshold (float): correlation above which a feature is a near duplicate. None skips it.
+        min_auc_gain (float): distance of the AUC to 0.5 that keeps a feature.
+        min_iv (float): information value that keeps a feature.
+        sample_rows (int): rows of the correlation and relevance statistics.
+        block_size (int): columns per correlation block.
+        seed (int): seed of the row sample.
+    """
+
+    def __init__(
+        self,
+        corr_threshold: float = 0.995,
+        min_auc_gain: float = 0.002,
+        min_iv: float = 0.001,
+        sample_rows: int = 200_000,
+        block_size: int = 256,
+        seed: int = 0,
+    ):
+        self.corr_threshold = corr_threshold
+        self.min_auc_gain = min_auc_gain
+        self.min_iv = min_iv
+        self.sample_rows = sample_rows
+        self.block_size = block_size
+        self.seed = seed
+        self.digests: Dict[str, Dict[str, str]] = {}
+        self.added: Dict[str, Dict[str, str]] = {}
+        self.dropped: Dict[str, Dict[str, str]] = {}
+        self.elapsed = 0.0
+
+    def _correlated(self, sample: pl.DataFrame, columns: List[str]) -> Dict[str, str]:
+        finite = [pl.when(pl.col(c).cast(pl.Float64).is_finite()).then(pl.col(c).cast(pl.Float64)) for c in columns]
+        # nulls at the mean, so they add nothing to the covariance
+        x = sample.select([(c - c.mean()).fill_null(0.0) for c in finite]).to_numpy()
+        x /= np.maximum(np.linalg.norm(x, axis=0), 1e-12)
+
+        dropped = {}
+        kept = np.zeros((len(x), 0))
+        kept_names: List[str] = []
+        for index in range(0, len(columns), self.block_size):
+            block = x[:, index : index + self.block_size]
+            against_kept = np.abs(kept.T @ block).max(axis=0) if kept.shape[1] > 0 else np.zeros(block.shape[1])
+            within = np.abs(np.triu(block.T @ block, 1))
+            keep = []
+            for j in range(block.shape[1]):
+                name = columns[index + j]
+                if against_kept[j] > self.corr_threshold:
+                    dropped[name] = kept_names[int(np.abs(kept.T @ block[:, j]).argmax())]
+                elif len(keep) > 0 and within[keep, j].max() > self.corr_threshold:
+                    dropped[name] = columns[index + keep[int(within[keep, j].argmax())]]
+                else:
+                    keep.append(j)
+            kept = np.hstack([kept, block[:, keep]])
+            kept_names += [columns[index + j] for j in keep]
+        return dropped
+
+    def screen(self, topic: str, frame: pl.DataFrame) -> Tuple[pl.DataFrame, Dict[str, str]]:
+        """
+        frame without the screened features, and the reason each one was dropped.
+        """
+        start_time = time.perf_counter()
+        reserved = [c for c in [*KEY_COL, *TARGET_COL] if c in frame.columns]
+        columns = [c for c in frame.columns if c not in reserved]
+        dropped: Dict[str, str] = {}
+
+        stats = frame.select(
+            *[pl.col(c).null_count().alias(f'{c}/null') for c in columns],
+            *[pl.col(c).drop_nulls().n_unique().alias(f'{c}/unique') for c in columns],
+        ).row(0, named=True)
+        for c in columns:
+            if stats[f'{c}/null'] == len(frame):
+                dropped[c] = 'null'
+            elif stats[f'{c}/unique'] <= 1 and stats[f'{c}/null'] == 0:
+                dropped[c] = 'constant'
+        columns = [c for c in columns if c not in dropped]
+
+        seen = self.digests.setdefault(topic, {})
+        added = self.added[topic] = {}
+        for c, digest in column_digests(frame, columns).items():
+            if digest in seen:
+                dropped[c] = 'duplicate'
+            else:
+                seen[digest] = added[digest] = c
+        columns = [c for c in columns if c not in dropped]
+
+        sample = frame.sample(min(self.sample_rows, len(frame)), seed=self.seed)
+        numeric = [c for c in columns if frame.schema[c].is_numeric() or frame.schema[c] == pl.Boolean]
+        if self.corr_threshold is not None and len(numeric) > 1:
+            for c in self._correlated(sample, numeric):
+                dropped[c] = 'correlated'
+            columns = [c for c in columns if c not in dropped]
+            numeric = [c for c in numeric if c not in dropped]
+
+        if len(TARGET_COL) > 0 and TARGET_COL[0] in frame.columns and len(columns) > 0:
+            y = sample[TARGET_COL[0]].to_numpy()
+            auc_gain = dict.fromkeys(columns, 0.0)
+            if len(numeric) > 0:
+                x = sample.select(pl.col(numeric).cast(pl.Float64).fill_nan(None)).to_numpy()
+                auc_gain.update(zip(numeric, np.abs(univariate_auc(x, y) - 0.5)))
+            iv = information_value(sample, columns, TARGET_COL[0])
+            for c in columns:
+                if auc_gain[c] < self.min_auc_gain and iv[c] < self.min_iv:
+                    dropped[c] = 'uninformative'
+
+        self.dropped.setdefault(topic, {}).update(dropped)
+        self.elapsed += time.perf_counter() - start_time
+        return frame.drop(list(dropped)), dropped
+
+    def report(self) -> str:
+        counts = {reason: 0 for reason in SCREEN_REASONS}
+        for dropped in self.dropped.values():
+            for reason in dropped.values():
+                counts[reason] += 1
+        return (
+            f'[*] Screening dropped {sum(counts.values())} features in {self.elapsed:.2f}s: '
+            + ', '.join(f'{count} {reason}' for reason, count in counts.items())
+        )
@@ -0,0 +1,277 @@
+from typing import Dict, List, Tuple, Union
+import numpy as np
+import polars as pl
+
+from dataset.feature.feature import Feature
+from dataset.feature.compiler import ExprCompiler, CAST_TYPES
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+SEGMENTED_AGGREGATIONS = ('count', 'sum', 'min', 'max', 'avg', 'stddev')
+BACKENDS = ('auto', 'numpy', 'numba')
+BLOCK_SIZE = 64
+
+
+def _reduce_numpy(
+    x: np.ndarray, valid: np.ndarray, starts: np.ndarray, lengths: np.ndarray, extremes: bool, moments: bool
+):
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=1)
+    total = np.add.reduceat(np.where(valid, x, 0.0), starts, axis=1)
+    low, high, squares = None, None, None
+    if extremes:
+        low = np.minimum.reduceat(np.where(valid, x, np.inf), starts, axis=1)
+        high = np.maximum.reduceat(np.where(valid, x, -np.inf), starts, axis=1)
+    if moments:
+        # squared deviations from the group mean, a second pass instead of a sum of squares
+        mean = total / np.maximum(count, 1)
+        deviation = np.where(valid, x - np.repeat(mean, lengths, axis=1), 0.0)
+        squares = np.add.reduceat(deviation * deviation, starts, axis=1)
+    return count, total, low, high, squares
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _reduce_numba(x, valid, starts, lengths, extremes, moments):
+        n_values, n_groups = x.shape[0], len(starts)
+        count = np.zeros((n_values, n_groups), np.int64)
+        total = np.zeros((n_values, n_groups))
+        low = np.full((n_values, n_groups), np.inf)
+        high = np.full((n_values, n_groups), -np.inf)
+        squares = np.zeros((n_values, n_groups))
+        for v in prange(n_values):
+            for g in range(n_groups):
+                start, end = starts[g], starts[g] + lengths[g]
+                # branch free, x is 0 where the value is missing
+                n, s = 0, 0.0
+                lo, hi = np.inf, -np.inf
+                for i in range(start, end):
+                    n += valid[v, i]
+                    s += x[v, i]
+                if extremes:
+                    for i in range(start, end):
+                        lo = min(lo, x[v, i] if valid[v, i] else np.inf)
+                        hi = max(hi, x[v, i] if valid[v, i] else -np.inf)
+                count[v, g], total[v, g], low[v, g], high[v, g] = n, s, lo, hi
+                if moments and count[v, g] > 1:
+                    mean = total[v, g] / count[v, g]
+                    for i in range(start, end):
+                        if valid[v, i]:
+                            squares[v, g] += (x[v, i] - mean) ** 2
+        return count, total, low, high, squares
+else:
+    _reduce_numba = None
+
+
+def _count_distinct(series: pl.Series, group_ids: np.ndarray, n_groups: int) -> np.ndarray:
+    codes = series.rank('dense').fill_null(0).to_numpy().astype(np.int64)
+    valid = codes > 0
+    keys = np.unique(group_ids[valid] * (codes.max() + 1) + codes[valid])
+    return np.bincount(keys // (codes.max() + 1), minlength=n_groups)
+
+
+class SegmentedEngine:
+    """
+    Grouped feature aggregation as segmented reductions over sorted buffers.
+
+    The frame is sorted by the group columns once and group offsets are
+    computed from the key changes. The masked value of every distinct
+    (aggregated value, filter set) pair is evaluated in one polars select and
+    reduced per contiguous segment, BLOCK_SIZE values at a time, to count,
+    sum, min, max and the squared deviations from which avg and stddev
+    follow, with NumPy reduceat or a parallel Numba kernel. count distinct
+    is counted on dense ranks per segment. Features outside of it (non
+    numeric values, other aggregations) are returned to the caller.
+
+    Args:
+        backend (str): 'numpy', 'numba' or 'auto' for numba when it is installed.
+    """
+
+    def __init__(self, backend: str = 'auto'):
+        if backend not in BACKENDS:
+            raise ValueError(f'backend should be one of {BACKENDS}. Not {backend}.')
+        if backend == 'auto':
+            backend = 'numba' if njit is not None else 'numpy'
+        if backend == 'numba' and njit is None:
+            raise ImportError('numba is not installed, use the numpy backend.')
+        self.backend = backend
+
+    def _reduce(
+        self, x: np.ndarray, valid: np.ndarray, starts: np.ndarray, lengths: np.ndarray, funcs: set
+    ):
+        extremes = len(funcs & {'min', 'max'}) > 0
+        moments = 'stddev' in funcs
+        if self.backend == 'numba':
+            return _reduce_numba(x, valid, starts, lengths, extremes, moments)
+        return _reduce_numpy(x, valid, starts, lengths, extremes, moments)
+
+    def plan(
+        self, schema, features: List[Feature]
+    ) -> Tuple[Dict[str, pl.Expr], Dict[str, List[Tuple[str, bool, Feature]]], List[Feature]]:
+        """
+        Distinct masked values to evaluate, the features reducing each of
+        them, and the features this engine does not handle.
+        """
+        compiler = ExprCompiler(schema)
+        values: Dict[Tuple[str, str], pl.Expr] = {}
+        reductions: Dict[Tuple[str, str], List[Tuple[str, bool, Feature]]] = {}
+        unsupported: List[Feature] = []
+        for feature in features:
+            try:
+                func, distinct, inner = compiler._split_agg(feature.agg)
+                if (
+                    feature.agg.data_type not in CAST_TYPES
+                    or (distinct and func != 'count')
+                    or (not distinct and func not in SEGMENTED_AGGREGATIONS)
+                ):
+                    raise NotImplementedError(f'{feature.name} is not supported')
+                key = (
+                    inner.format(*[c.query or c.name for c in feature.agg.columns]),
+                    compiler.filter_key(feature.filters),
+                )
+                if key not in values:
+                    values[key] = compiler.compile_value(
+                        feature.agg, compiler.compile_filters(feature.filters)
+                    )
+            except NotImplementedError:
+                unsupported.append(feature)
+                continue
+            reductions.setdefault(key, []).append((func, distinct, feature))
+
+        names = {key: f'__value_{i}__' for i, key in enumerate(values)}
+        return (
+            {names[key]: value for key, value in values.items()},
+            {names[key]: features for key, features in reductions.items()},
+            unsupported,
+        )
+
+    def query(
+        self, frame: Union[pl.DataFrame, pl.LazyFrame], features: List[Feature], group_cols: List[str]
+    ) -> Tuple[pl.DataFrame, List[Feature]]:
+        """
+        Features of each group and the features left for another engine.
+        """
+        if isinstance(frame, pl.LazyFrame):
+            frame = frame.collect(engine='streaming')
+        values, reductions, unsupported = self.plan(frame.schema, features)
+
+        # one sort and one vectorized pass over every masked value
+        buffers = frame.sort(group_cols).select(
+            [*group_cols, *[value.alias(name) for name, value in values.items()]]
+        )
+        changed = buffers.select(
+            pl.any_horizontal([pl.col(c).ne_missing(pl.col(c).shift(1)) for c in group_cols])
+        ).to_series().fill_null(True).to_numpy()
+        starts = np.flatnonzero(changed)
+        lengths = np.diff(np.append(starts, len(buffers)))
+        group_ids = np.repeat(np.arange(len(starts)), lengths)
+        result = buffers.select(group_cols)[starts]
+
+        reduced: Dict[str, set] = {}
+        for name, features_of_value in reductions.items():
+            numeric = buffers[name].dtype.is_numeric() or buffers[name].dtype == pl.Boolean
+            if not numeric:
+                # only count and count distinct work on non numeric values
+                unsupported += [
+                    feature for func, distinct, feature in features_of_value
+                    if not distinct and func != 'count'
+                ]
+                features_of_value = reductions[name] = [
+                    (func, distinct, feature) for func, distinct, feature in features_of_value
+                    if distinct or func == 'count'
+                ]
+            funcs = {func for func, distinct, _ in features_of_value if not distinct}
+            if len(funcs) > 0:
+                reduced[name] = funcs
+        # values needing the same statistics share blocks, the others are not computed
+        order = sorted(reduced, key=lambda name: (
+            len(reduced[name] & {'min', 'max'}) > 0, 'stddev' in reduced[name]
+        ))
+
+        stats: Dict[str, Dict[str, np.ndarray]] = {}
+        for index in range(0, len(order), BLOCK_SIZE):
+            block = order[index : index + BLOCK_SIZE]
+            # (values, rows) buffers, so every value of a block is reduced in one call
+            x = buffers.select([
+                pl.col(name).cast(pl.Float64).fill_null(0)
+                if buffers[name].dtype.is_numeric() or buffers[name].dtype == pl.Boolean
+                else pl.lit(0.0).alias(name)
+                for name in block
+            ]).to_numpy(order='fortran').T
+            valid = buffers.select(pl.col(block).is_not_null()).to_numpy(order='fortran').T
+            funcs = set().union(*[reduced[name] for name in block])
+            count, total, low, high, squares = self._reduce(x, valid, starts, lengths, funcs)
+            empty = count == 0
+            block_stats = {
+                'count': count,
+                'sum': np.where(empty, np.nan, total),
+                'avg': np.where(empty, np.nan, total / np.maximum(count, 1)),
+            }
+            if low is not None:
+                block_stats['min'] = np.where(empty, np.nan, low)
+                block_stats['max'] = np.where(empty, np.nan, high)
+            if squares is not None:
+                block_stats['stddev'] = np.where(
+                    count > 1, np.sqrt(squares / np.maximum(count - 1, 1)), np.nan
+                )
+            for i, name in enumerate(block):
+                stats[name] = {func: values[i] for func, values in block_stats.items()}
+
+        columns = []
+        for name, features_of_value in reductions.items():
+            for func, distinct, feature in features_of_value:
+                if distinct:
+                    values_of_feature = _count_distinct(buffers[name], group_ids, len(starts))
+                elif name in stats:
+                    values_of_feature = stats[name][func]
+                else:
+                    continue
+                columns.append(
+                    pl.Series(feature.name, values_of_feature, nan_to_null=True)
+                    .cast(CAST_TYPES[feature.agg.data_type])
+                )
+        return result.with_columns(columns), unsupported
+
+
+if __name__ == '__main__':
+    ## parity with the expression path and timing against the sql path
+    import json
+    import time
+    from polars.testing import assert_frame_equal
+    from dataset.feature.compiler import synthetic_frame
+    from dataset.feature.feature_loader import FeatureLoader
+
+    n_rows = 300_000
+    n_cases = 30_000
+    for topic in ['applprev', 'credit_bureau_a']:
+        with open(f'data/feature_definition_new/{topic}.json', 'r') as f:
+            features = [Feature.from_dict(feature) for feature in json.load(f).values()]
+        # polars sql keeps DATE() differences as durations, leave them out of the comparison
+        features = [feature for feature in features if 'date(' not in feature.query.lower()]
+        frame = synthetic_frame(features, n_rows, n_cases)
+        group_cols = ['case_id', 'target']
+
+        runs = {
+            'sql': lambda: FeatureLoader.query_sql(frame, features, group_cols),
+            'expr': lambda: FeatureLoader.query_expr(frame, features, group_cols),
+            'segmented[numpy]': lambda: FeatureLoader.query_segmented(frame, features, group_cols, 'numpy'),
+        }
+        if njit is not None:
+            # compile the kernel outside of the timing
+            SegmentedEngine('numba').query(frame.head(1000), features, group_cols)
+            runs['segmented[numba]'] = lambda: FeatureLoader.query_segmented(frame, features, group_cols, 'numba')
+
+        results = {}
+        for name, run in runs.items():
+            start_time = time.perf_counter()
+            results[name] = run().sort(group_cols)
+            print(f'[*] {topic} ({len(features)} features, {n_rows} rows) {name}: {time.perf_counter() - start_time:.2f}s')
+        _, unsupported = SegmentedEngine('numpy').query(frame.head(100), features, group_cols)
+        print(f'[*] {len(unsupported)} features fall back to expr')
+        for name in runs:
+            if name.startswith('segmented'):
+                assert_frame_equal(results['expr'], results[name], check_dtypes=False, rel_tol=1e-6)
+        print('[*] segmented results match the expression path')
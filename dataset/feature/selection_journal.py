@@ -0,0 +1,243 @@
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from dataset.feature.feature_selector import SELECT_PATH, BatchResult
+
+
+JOURNAL_PATH = SELECT_PATH / 'journal.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY,
+    source TEXT,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS topics (
+    stage TEXT,
+    topic TEXT,
+    status TEXT,
+    n_features INTEGER,
+    n_batches INTEGER,
+    n_selected INTEGER,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (stage, topic)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    stage TEXT,
+    topic TEXT,
+    batch INTEGER,
+    status TEXT,
+    features TEXT,
+    selected TEXT,
+    build_sec REAL,
+    train_sec REAL,
+    train_auc REAL,
+    test_auc REAL,
+    finished_at REAL,
+    PRIMARY KEY (stage, topic, batch)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    stage TEXT,
+    topic TEXT,
+    digest TEXT,
+    feature TEXT,
+    batch INTEGER,
+    PRIMARY KEY (stage, topic, digest)
+);
+'''
+
+
+class SelectionJournal:
+    """
+    Durable record of selection runs in SQLite.
+
+    A stage is one selection pass over every topic ('primary', 'secondary',
+    ...), reading the features its source stage selected. When a topic is
+    first planned in a stage its batches are stored with the feature names
+    of each, so a resumed run rebuilds exactly the same batches whatever the
+    order of the feature list, and completed batches are skipped without
+    recomputing their features. Every batch result is committed in its own
+    transaction, so a crash loses at most the batches in flight. The column
+    digests a batch added to the screener are stored with it, so duplicates
+    of a done batch are still screened out after a resume.
+
+    Args:
+        path (Path): journal database.
+    """
+
+    def __init__(self, path: Path = JOURNAL_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add_stage(self, stage: str, source: str = None):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO stages VALUES (?, ?, ?)', (stage, source, time.time())
+            )
+
+    def source(self, stage: str) -> Optional[str]:
+        row = self.conn.execute('SELECT source FROM stages WHERE stage = ?', (stage,)).fetchone()
+        if row is None:
+            raise ValueError(f'Stage {stage} is not in the journal.')
+        return row[0]
+
+    def plan(self, stage: str, topic: str, feature_names: List[str], batch_size: int) -> List[List[str]]:
+        """
+        Feature names of every batch of a topic, split batch_size at a time
+        the first time the topic is planned in the stage and read back after.
+        A topic without features is planned done, with no batches.
+        """
+        planned = self.conn.execute(
+            'SELECT 1 FROM topics WHERE stage = ? AND topic = ?', (stage, topic)
+        ).fetchone()
+        if planned is not None:
+            rows = self.conn.execute(
+                'SELECT features FROM batches WHERE stage = ? AND topic = ? ORDER BY batch', (stage, topic)
+            ).fetchall()
+            return [json.loads(features) for features, in rows]
+
+        batches = [feature_names[i : i + batch_size] for i in range(0, len(feature_names), batch_size)]
+        now = time.time()
+        with self.conn:
+            if len(batches) == 0:
+                # nothing to select from, the topic is done with no features
+                self.conn.execute(
+                    'INSERT INTO topics VALUES (?, ?, ?, 0, 0, 0, ?, ?)', (stage, topic, 'done', now, now)
+                )
+                return batches
+            self.conn.execute(
+                'INSERT INTO topics VALUES (?, ?, ?, ?, ?, NULL, ?, NULL)',
+                (stage, topic, 'pending', len(feature_names), len(batches), now),
+            )
+            self.conn.executemany(
+                'INSERT INTO batches (stage, topic, batch, status, features) VALUES (?, ?, ?, ?, ?)',
+                [(stage, topic, i, 'pending', json.dumps(names)) for i, names in enumerate(batches)],
+            )
+        return batches
+
+    def import_selected(self, stage: str, topic: str, feature_names: List[str]):
+        """
+        Record the result of a pass run outside of the journal as a done topic
+        of a single batch.
+        """
+        if self.is_done(stage, topic):
+            return
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO topics VALUES (?, ?, ?, ?, 1, ?, ?, ?)',
+                (stage, topic, 'done', len(feature_names), len(feature_names), time.time(), time.time()),
+            )
+            self.conn.execute('DELETE FROM batches WHERE stage = ? AND topic = ?', (stage, topic))
+            self.conn.execute('DELETE FROM digests WHERE stage = ? AND topic = ?', (stage, topic))
+            self.conn.execute(
+                "INSERT INTO batches (stage, topic, batch, status, features, selected, finished_at) "
+                "VALUES (?, ?, 0, 'done', ?, ?, ?)",
+                (stage, topic, json.dumps(feature_names), json.dumps(feature_names), time.time()),
+            )
+
+    def done_batches(self, stage: str, topic: str) -> Set[int]:
+        rows = self.conn.execute(
+            "SELECT batch FROM batches WHERE stage = ? AND topic = ? AND status = 'done'", (stage, topic)
+        ).fetchall()
+        return {batch for batch, in rows}
+
+    def is_done(self, stage: str, topic: str) -> bool:
+        row = self.conn.execute(
+            'SELECT status FROM topics WHERE stage = ? AND topic = ?', (stage, topic)
+        ).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def record(self, stage: str, result: BatchResult):
+        """
+        Store a trained batch, and close its topic once every batch is done.
+        """
+        with self.conn:
+            self.conn.execute(
+                '''
+                UPDATE batches SET status = 'done', selected = ?, build_sec = ?, train_sec = ?,
+                    train_auc = ?, test_auc = ?, finished_at = ?
+                WHERE stage = ? AND topic = ? AND batch = ?
+                ''',
+                (
+                    json.dumps(result.selected), result.build_sec, result.train_sec,
+                    result.scores.get('train_auc'), result.scores.get('test_auc'), time.time(),
+                    stage, result.name, result.index,
+                ),
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO digests VALUES (?, ?, ?, ?, ?)',
+                [(stage, result.name, digest, feature, result.index) for digest, feature in result.digests.items()],
+            )
+            remaining = self.conn.execute(
+                "SELECT count(*) FROM batches WHERE stage = ? AND topic = ? AND status != 'done'",
+                (stage, result.name),
+            ).fetchone()[0]
+            if remaining == 0:
+                self.conn.execute(
+                    "UPDATE topics SET status = 'done', n_selected = ?, finished_at = ? WHERE stage = ? AND topic = ?",
+                    (len(self._selected(stage, result.name)), time.time(), stage, result.name),
+                )
+
+    def digests(self, stage: str, topic: str) -> Dict[str, str]:
+        """
+        Column digests of the done batches of a topic, to seed FeatureScreener.digests.
+        """
+        rows = self.conn.execute(
+            'SELECT digest, feature FROM digests WHERE stage = ? AND topic = ? ORDER BY batch', (stage, topic)
+        ).fetchall()
+        return dict(rows)
+
+    def _selected(self, stage: str, topic: str) -> List[str]:
+        rows = self.conn.execute(
+            'SELECT selected FROM batches WHERE stage = ? AND topic = ? ORDER BY batch', (stage, topic)
+        ).fetchall()
+        return [name for selected, in rows if selected is not None for name in json.loads(selected)]
+
+    def selected(self, stage: str, topic: str) -> List[str]:
+        """
+        Features a stage selected for a topic, in batch order.
+        """
+        if not self.is_done(stage, topic):
+            raise ValueError(f'{topic} is not done in stage {stage}.')
+        return self._selected(stage, topic)
+
+    def stage_input(self, stage: str, topic: str) -> Optional[List[str]]:
+        """
+        Features a stage selects from: those of its source stage, None (every
+        defined feature) for a stage without source.
+        """
+        source = self.source(stage)
+        return None if source is None else self.selected(source, topic)
+
+    def summary(self, stage: str) -> Dict[str, dict]:
+        rows = self.conn.execute(
+            '''
+            SELECT t.topic, t.status, t.n_features, t.n_batches,
+                coalesce(sum(b.status = 'done'), 0), sum(b.build_sec), sum(b.train_sec), avg(b.test_auc)
+            FROM topics t LEFT JOIN batches b ON t.stage = b.stage AND t.topic = b.topic
+            WHERE t.stage = ? GROUP BY t.topic ORDER BY t.topic
+            ''',
+            (stage,),
+        ).fetchall()
+        keys = ['status', 'n_features', 'n_batches', 'n_done', 'build_sec', 'train_sec', 'test_auc']
+        return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+    def report(self, stage: str) -> str:
+        lines = [f'[*] Stage {stage}']
+        for topic, s in self.summary(stage).items():
+            lines.append(
+                f'    {topic}: {s["status"]}, {s["n_done"]}/{s["n_batches"]} batches of '
+                f'{s["n_features"]} features, build {s["build_sec"] or 0:.2f}s, '
+                f'train {s["train_sec"] or 0:.2f}s, mean test AUC {s["test_auc"] or 0:.4f}'
+            )
+        return '\n'.join(lines)
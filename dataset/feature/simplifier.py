@@ -0,0 +1,139 @@
+import re
+from typing import Dict, List, Optional, Tuple, Union
+
+from dataset.feature.feature import Agg, Feature, Filter
+
+
+# filters simplify to a Filter, to TRUE (keeps every row) or to FALSE (keeps none)
+TRUE = 'TRUE'
+FALSE = 'FALSE'
+
+# aggregations of an empty group
+ZERO_AGGS = ('count({0})', 'count(distinct {0})')
+
+
+class FeatureSimplifier:
+    """
+    Canonical form of features from the column profiles of their topic, to
+    find features that always produce the same column.
+
+    Filters are rewritten to TRUE or FALSE when the profile decides them:
+    num_group1 < k above the largest group, a period shorter than every date
+    difference, is null / is not null on columns without or with only nulls.
+    A period filter on a column with nulls is the is not null filter of the
+    column. Aggregations are rewritten when the profile decides them too:
+    count of any column without nulls counts the rows, count(distinct) of a
+    constant column without nulls is whether a row passes the filter, and
+    min, max and avg of such a column are its value. Under a FALSE filter
+    every count is 0 and every other aggregation null.
+
+    Profiles should cover the whole table ('exact' or 'stream' profiler),
+    bounds of a sample do not decide anything.
+
+    Args:
+        profiles (Dict[str, dict]): column profiles, see profile_columns.
+    """
+
+    def __init__(self, profiles: Dict[str, dict]):
+        self.profiles = profiles
+
+    def _nulls(self, col: str) -> Tuple[bool, bool]:
+        """
+        Whether col has no nulls, and whether it has nothing but nulls.
+        """
+        profile = self.profiles.get(col)
+        if profile is None:
+            return False, False
+        return profile['null_count'] == 0, profile['null_count'] == profile['rows']
+
+    def _constant(self, col: str) -> bool:
+        profile = self.profiles.get(col, {})
+        no_nulls, _ = self._nulls(col)
+        return no_nulls and profile.get('lowest') is not None and profile.get('lowest') == profile.get('highest')
+
+    def simplify_filter(self, filter: Optional[Filter]) -> Union[Filter, str]:
+        if filter is None:
+            return TRUE
+        col = filter.columns[0].name
+        profile = self.profiles.get(col)
+        if profile is None:
+            return filter
+        no_nulls, all_nulls = self._nulls(col)
+        logic = filter.logic
+
+        if logic == f'{col} is null':
+            return TRUE if all_nulls else FALSE if no_nulls else filter
+        if logic == f'{col} is not null':
+            return FALSE if all_nulls else TRUE if no_nulls else filter
+        if all_nulls:
+            # comparisons with null are never true
+            return FALSE
+
+        match = re.fullmatch(rf'{re.escape(col)} (<|=) (-?[\d.]+)', logic)
+        if match is not None and isinstance(profile.get('highest'), float):
+            value = float(match.group(2))
+            lowest, highest = profile['lowest'], profile['highest']
+            if match.group(1) == '<':
+                if no_nulls and highest < value:
+                    return TRUE
+                if lowest >= value:
+                    return FALSE
+            elif value < lowest or value > highest:
+                return FALSE
+            return filter
+
+        match = re.fullmatch(rf'date\(date_decision\)-date\({re.escape(col)}\) < (-?[\d.]+)', logic)
+        if match is not None and profile.get('date_diff_max') is not None:
+            if profile['date_diff_max'] < float(match.group(1)):
+                if no_nulls:
+                    return TRUE
+                return Filter(filter.columns, f'{col} is not null')
+        return filter
+
+    def _agg_key(self, agg: Agg, filter: Union[Filter, str]) -> tuple:
+        col = agg.columns[0].name
+        if filter == FALSE:
+            return ('zero',) if agg.logic in ZERO_AGGS else ('null',)
+        filter_key = filter if filter == TRUE else str(filter)
+        no_nulls, _ = self._nulls(col)
+        if agg.logic == 'count({0})' and no_nulls:
+            return ('rows', filter_key)
+        if self._constant(col):
+            if agg.logic == 'count(distinct {0})':
+                return ('any_row', filter_key)
+            if agg.logic in ('min({0})', 'max({0})', 'avg({0})'):
+                return ('value', agg.data_type, col, filter_key)
+        return (agg.logic, agg.data_type, tuple(c.name for c in agg.columns), filter_key)
+
+    def key(self, feature: Feature) -> tuple:
+        """
+        Features with the same key always produce the same column.
+        """
+        filters = [self.simplify_filter(filter) for filter in feature.filters]
+        filters = [filter for filter in filters if filter != TRUE]
+        if FALSE in filters:
+            return self._agg_key(feature.agg, FALSE)
+        if len(filters) > 1:
+            # several filters are kept apart, only the single filter ones are canonicalized
+            return (feature.agg.logic, feature.agg.data_type, feature.query)
+        return self._agg_key(feature.agg, filters[0] if len(filters) > 0 else TRUE)
+
+    def dedupe(self, features: List[Feature]) -> Tuple[List[Feature], Dict[str, str]]:
+        """
+        One feature of every key, in the order of features, and the feature
+        each dropped one duplicates. The feature with the fewest filters
+        represents its key, the first one on ties.
+        """
+        keys = [self.key(feature) for feature in features]
+        representatives: Dict[tuple, int] = {}
+        for i, (feature, key) in enumerate(zip(features, keys)):
+            kept = representatives.get(key)
+            if kept is None or len(feature.filters) < len(features[kept].filters):
+                representatives[key] = i
+        kept = sorted(representatives.values())
+        duplicates = {
+            feature.name: features[representatives[key]].name
+            for i, (feature, key) in enumerate(zip(features, keys))
+            if representatives[key] != i
+        }
+        return [features[i] for i in kept], duplicates
@@ -0,0 +1,302 @@
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Union
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from lightgbm import Booster
+
+from dataset.datainfo import RawInfo, RawReader, BASE_PATH
+from dataset.const import TOPICS, Topic, KEY_COL, DATE_COL, TARGET_COL, DEPTH_2_TO_1_QUERY
+from dataset.feature.feature import Feature
+from dataset.feature.feature_definer import FEATURE_DEF_PATH
+from dataset.feature.definition_store import DefinitionStore, DEFINITION_SUFFIX, definition_path
+from dataset.feature.feature_loader import FeatureLoader, CompiledQuery
+from dataset.feature.preprocessor import aggregate_depth2
+from dataset.feature.util import apply_dtype_plan, load_dtype_plan
+
+
+MODEL_PATH = BASE_PATH / 'data' / 'model'
+
+Records = Union[pl.DataFrame, pa.RecordBatch, pa.Table, List[dict], Dict[str, list]]
+
+
+def to_frame(records: Records) -> pl.DataFrame:
+    if isinstance(records, pl.DataFrame):
+        return records
+    if isinstance(records, (pa.RecordBatch, pa.Table)):
+        return pl.from_arrow(records)
+    return pl.DataFrame(records, infer_schema_length=None)
+
+
+class OnlineScorer:
+    """
+    Score one application at a time from its raw records.
+
+    Selected model features are resolved against the feature definitions of
+    the depth 1 topics, the remaining ones are depth 0 columns used as they
+    are. Requests are keyed like the raw files: 'base', 'static_0',
+    'applprev_1', 'applprev_2', ... Records are cast with the dtype plans
+    stored by the preprocessor, depth 2 records go through the same
+    aggregation, and feature expressions are compiled once per topic, so a
+    request only runs a few small polars queries and a single row prediction.
+
+    Args:
+        model_name (str): directory under data/model holding artifacts.json and model.pkl.
+        model_dir (Path): model directory, overrides model_name.
+        feature_def_path (Path): directory of the feature definitions, see definition_path.
+    """
+
+    def __init__(
+        self,
+        model_name: str = 'lgbm_test',
+        model_dir: Path = None,
+        feature_def_path: Path = FEATURE_DEF_PATH,
+    ):
+        self.model_dir = Path(model_dir) if model_dir is not None else MODEL_PATH / model_name
+        with open(self.model_dir / 'artifacts.json', 'r') as f:
+            artifacts = json.load(f)
+        self.feature_names: List[str] = artifacts['features']
+        self.booster = Booster(model_file=str(self.model_dir / 'model.pkl'))
+
+        # lightgbm keeps the category order of every categorical feature it was trained on
+        categories = self.booster.pandas_categorical or []
+        self.categories = {
+            self.feature_names[index]: {str(value): code for code, value in enumerate(values)}
+            for index, values in zip(artifacts['cat_indicis'], categories)
+        }
+
+        self.topic_features = self._resolve_features(Path(feature_def_path))
+        defined = {feat.name for features in self.topic_features.values() for feat in features}
+        self.raw_columns = [name for name in self.feature_names if name not in defined]
+
+        self.plans: Dict[str, dict] = {}
+        self.queries: Dict[str, CompiledQuery] = {}
+        self.depth0_topics = [
+            topic.name for topic in TOPICS
+            if topic.depth == 0
+            and RawInfo.get_dtype_plan_path(topic.name, 0).exists()
+            and any(col in self._plan(topic.name, 0) for col in self.raw_columns)
+        ]
+        depth0_columns = {col for topic in self.depth0_topics for col in self._plan(topic, 0)}
+        unresolved = [name for name in self.raw_columns if name not in depth0_columns]
+        if len(unresolved) > 0:
+            # scoring them as nulls would silently predict from missing inputs
+            raise ValueError(
+                f'{len(unresolved)} model features are neither defined in {feature_def_path} nor depth 0 '
+                f'columns with a dtype plan (preprocess train and define features first): {unresolved}'
+            )
+        self.encoders = [self._encoder(name) for name in self.feature_names]
+
+    def _resolve_features(self, feature_def_path: Path) -> Dict[str, List[Feature]]:
+        topic_features = {}
+        for topic in TOPICS:
+            if topic.depth != 1:
+                continue
+            try:
+                path = definition_path(feature_def_path, topic.name)
+            except FileNotFoundError:
+                continue
+            if path.suffix == DEFINITION_SUFFIX:
+                # only the selected definitions are read
+                store = DefinitionStore(path)
+                features = store.load(store.defined(self.feature_names))
+                store.close()
+            else:
+                selected = set(self.feature_names)
+                with open(path, 'r') as f:
+                    definitions = json.load(f)
+                features = [
+                    Feature.from_dict(definition)
+                    for name, definition in definitions.items()
+                    if name in selected
+                ]
+            if len(features) > 0:
+                topic_features[topic.name] = features
+        return topic_features
+
+    def _plan(self, name: str, depth: int) -> dict:
+        key = f'{name}_{depth}'
+        if key not in self.plans:
+            path = RawInfo.get_dtype_plan_path(name, depth)
+            if not path.exists():
+                raise FileNotFoundError(f'{path} does not exist. Preprocess train first.')
+            self.plans[key] = load_dtype_plan(path)
+        return self.plans[key]
+
+    def _encoder(self, name: str) -> pl.Expr:
+        if name in self.categories:
+            # unseen categories become nan, as lightgbm does for pandas categoricals
+            return (
+                pl.col(name)
+                .cast(pl.Utf8)
+                .replace_strict(self.categories[name], default=None, return_dtype=pl.Float64)
+            )
+        return pl.col(name).cast(pl.Float64)
+
+    @staticmethod
+    def _conform(frame: pl.DataFrame, plan: dict) -> pl.DataFrame:
+        """
+        Cast a frame to the prep schema, adding columns the records lack as nulls.
+        """
+        missing = [pl.lit(None, dtype).alias(col) for col, dtype in plan.items() if col not in frame.columns]
+        frame = frame.with_columns(missing).select(list(plan))
+        return apply_dtype_plan(frame, plan)
+
+    def _depth1(self, topic: str, records: Dict[str, Records]) -> pl.DataFrame:
+        depth1 = to_frame(records.get(f'{topic}_1', []))
+        depth2 = to_frame(records.get(f'{topic}_2', []))
+        # depth 2 rows only reach the features through a depth 1 parent, so
+        # without one the join is skipped: the empty frame has no key columns
+        if topic in DEPTH_2_TO_1_QUERY and len(depth1) > 0 and len(depth2) > 0:
+            keys = ['case_id', 'num_group1']
+            agg, depth2_0 = aggregate_depth2(depth2, topic, DEPTH_2_TO_1_QUERY[topic])
+            depth1 = depth1.with_columns(pl.col(keys).cast(pl.Int64))
+            for part in [agg, depth2_0]:
+                depth1 = depth1.join(part.with_columns(pl.col(keys).cast(pl.Int64)), on=keys, how='left')
+        return self._conform(depth1, self._plan(topic, 1))
+
+    def _query(self, topic: str, frame: pl.DataFrame) -> pl.DataFrame:
+        if topic not in self.queries:
+            # fusing saves scans of large frames, on a request it only adds steps
+            self.queries[topic] = FeatureLoader.compile_query(
+                frame.schema, self.topic_features[topic], KEY_COL, fuse=False
+            )
+        temp = self.queries[topic].execute(frame)
+        if RawInfo.get_dtype_plan_path(f'{topic}_features', 1).exists():
+            temp = apply_dtype_plan(temp, self._plan(f'{topic}_features', 1))
+        return temp
+
+    def features(self, records: Dict[str, Records]) -> pl.DataFrame:
+        """
+        One row of the selected features of the application in records.
+        """
+        base = to_frame(records['base']).with_columns(pl.col(KEY_COL).cast(pl.Int32))
+        data = base
+        for topic in self.depth0_topics:
+            depth0 = self._conform(to_frame(records.get(f'{topic}_0', [])), self._plan(topic, 0))
+            depth0 = depth0.drop([col for col in depth0.columns if col in data.columns and col not in KEY_COL])
+            data = data.join(depth0, on=KEY_COL, how='left')
+
+        for topic in self.topic_features:
+            frame = self._depth1(topic, records).join(
+                base.select([*KEY_COL, *DATE_COL]), on=KEY_COL, how='inner'
+            )
+            data = data.join(self._query(topic, frame), on=KEY_COL, how='left')
+        return self._select(data)
+
+    def _select(self, data: pl.DataFrame) -> pl.DataFrame:
+        missing = [name for name in self.feature_names if name not in data.columns]
+        if len(missing) > 0:
+            raise ValueError(f'{len(missing)} model features were not computed: {missing}')
+        return data.select([*KEY_COL, *self.feature_names])
+
+    def predict(self, data: pl.DataFrame) -> np.ndarray:
+        return self.booster.predict(data.select(self.encoders).to_numpy())
+
+    def score(self, records: Dict[str, Records]) -> float:
+        """
+        Default probability of a single application.
+        """
+        return float(self.predict(self.features(records))[0])
+
+    @staticmethod
+    def merge(requests: List[Dict[str, Records]]) -> Dict[str, pl.DataFrame]:
+        """
+        Records of many requests as a single request. Each request is re-keyed
+        to its position, so requests sharing a case_id are scored apart.
+        """
+        frames: Dict[str, List[pl.DataFrame]] = {}
+        for i, records in enumerate(requests):
+            if 'base' not in records:
+                raise ValueError(f'Request {i} has no base record.')
+            for key, value in records.items():
+                frame = to_frame(value)
+                if key == 'base' and len(frame) != 1:
+                    raise ValueError(f'Request {i} should have exactly one base record.')
+                if frame.width == 0:
+                    continue
+                frames.setdefault(key, []).append(
+                    frame.with_columns(pl.lit(i, pl.Int64).alias(KEY_COL[0]))
+                )
+        return {key: pl.concat(parts, how='diagonal_relaxed') for key, parts in frames.items()}
+
+    def score_many(self, requests: List[Dict[str, Records]]) -> np.ndarray:
+        """
+        Default probabilities of many applications, with one feature pass and
+        one prediction for all of them.
+        """
+        data = self.features(self.merge(requests)).sort(KEY_COL)
+        return self.predict(data)
+
+    def score_batch(self, type_: str = 'train', conf: dict = None) -> pl.DataFrame:
+        """
+        Scores of every application from the prep files, through the batch feature path.
+        """
+        rawinfo = RawInfo(conf)
+        data = rawinfo.read_raw('base', reader=RawReader('polars'), type_=type_, columns=[*KEY_COL, *DATE_COL])
+        data = data.with_columns(pl.col(KEY_COL).cast(pl.Int32))
+        for topic in self.depth0_topics:
+            depth0 = rawinfo.read_raw(topic, depth=0, reader=RawReader('polars'), type_=type_, stage='prep')
+            depth0 = depth0.drop([col for col in depth0.columns if col in data.columns and col not in KEY_COL])
+            data = data.join(depth0, on=KEY_COL, how='left')
+
+        for topic, features in self.topic_features.items():
+            loader = FeatureLoader(Topic(topic, 1), type_, conf, projection=True)
+            temp = loader.load_feature_data(features)
+            temp = temp.drop([col for col in TARGET_COL if col in temp.columns])
+            data = data.join(temp, on=KEY_COL, how='left')
+        data = self._select(data)
+        return data.select(KEY_COL).with_columns(pl.Series('score', self.predict(data)))
+
+    def raw_records(
+        self, case_ids: List[int], type_: str = 'train', conf: dict = None
+    ) -> Dict[int, Dict[str, pa.Table]]:
+        """
+        Raw records of each case as small Arrow tables, shaped like a scoring request.
+        """
+        rawinfo = RawInfo(conf)
+        keys = [('base', None)] + [(topic, 0) for topic in self.depth0_topics]
+        for topic in self.topic_features:
+            keys.append((topic, 1))
+            if topic in DEPTH_2_TO_1_QUERY:
+                keys.append((topic, 2))
+
+        requests = {case_id: {} for case_id in case_ids}
+        for name, depth in keys:
+            raw = rawinfo.read_raw(name, depth=depth, reader=RawReader('lazy'), type_=type_)
+            raw = raw.filter(pl.col(KEY_COL[0]).is_in(case_ids)).collect()
+            parts = raw.partition_by(KEY_COL[0], as_dict=True)
+            key = name if depth is None else f'{name}_{depth}'
+            for case_id in case_ids:
+                requests[case_id][key] = parts.get((case_id,), raw.clear()).to_arrow()
+        return requests
+
+
+if __name__ == '__main__':
+    # parity with the batch path and single case latency
+    type_ = 'train'
+    n_cases = 200
+    scorer = OnlineScorer('lgbm_test')
+
+    batch = scorer.score_batch(type_)
+    case_ids = batch[KEY_COL[0]].sample(min(n_cases, len(batch)), seed=0).to_list()
+    requests = scorer.raw_records(case_ids, type_)
+
+    latencies = []
+    online = {}
+    for case_id, records in requests.items():
+        start_time = time.perf_counter()
+        online[case_id] = scorer.score(records)
+        latencies.append(time.perf_counter() - start_time)
+    # the first request compiles the feature expressions
+    latencies = np.array(latencies[1:]) * 1000
+    print(
+        f'[*] Latency over {len(latencies)} cases: p50 {np.percentile(latencies, 50):.2f} ms, '
+        f'p95 {np.percentile(latencies, 95):.2f} ms, max {latencies.max():.2f} ms'
+    )
+
+    expected = dict(batch.filter(pl.col(KEY_COL[0]).is_in(case_ids)).iter_rows())
+    diffs = np.array([abs(online[case_id] - expected[case_id]) for case_id in case_ids])
+    print(f'[*] Parity: max abs diff {diffs.max():.2e}, {(diffs > 1e-9).sum()} of {len(diffs)} cases differ')
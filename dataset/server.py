@@ -0,0 +1,266 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+
+from dataset.scorer import OnlineScorer, Records
+from dataset.const import KEY_COL
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent scoring requests into micro batches.
+
+    A batch is closed once it holds max_batch_size requests or max_wait_ms
+    passed since its first request, then scored with a single
+    OnlineScorer.score_many call in a worker thread, so the event loop keeps
+    accepting requests while a batch is being scored. A failing batch is
+    bisected, so a bad request does not fail the others.
+
+    Args:
+        scorer (OnlineScorer): scorer of the batches.
+        max_batch_size (int): most requests in a batch.
+        max_wait_ms (float): longest a request waits for its batch to fill.
+    """
+
+    def __init__(self, scorer: OnlineScorer, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue: asyncio.Queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes: List[int] = []
+
+    async def submit(self, records: Dict[str, Records]) -> float:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((records, future))
+        return await future
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._score(batch)
+
+    async def _score(self, batch: List[Tuple[Dict[str, Records], asyncio.Future]]):
+        self.batch_sizes.append(len(batch))
+        await self._score_many(batch)
+
+    async def _score_many(self, batch: List[Tuple[Dict[str, Records], asyncio.Future]]):
+        """
+        Score a batch, bisecting it when score_many raises, so only the
+        requests that fail on their own get the exception.
+        """
+        requests = [records for records, _ in batch]
+        try:
+            scores = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.scorer.score_many, requests
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                half = len(batch) // 2
+                await self._score_many(batch[:half])
+                await self._score_many(batch[half:])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), score in zip(batch, scores):
+            if not future.done():
+                future.set_result(float(score))
+
+
+class ScoringServer:
+    """
+    Minimal HTTP/1.1 scoring service on asyncio streams.
+
+    POST /score takes a JSON object of raw records keyed like the raw files
+    ('base', 'static_0', 'applprev_1', ...) and answers {"score": p}.
+    GET /health answers {"status": "ok"}. Connections are kept alive.
+
+    Args:
+        scorer (OnlineScorer): scorer of the requests.
+        host (str): address to bind.
+        port (int): port to bind, 0 picks a free one.
+        max_batch_size (int): most requests scored together.
+        max_wait_ms (float): longest a request waits for its batch to fill.
+    """
+
+    def __init__(
+        self,
+        scorer: OnlineScorer,
+        host: str = '127.0.0.1',
+        port: int = 8000,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        self.host = host
+        self.port = port
+        self.batcher = MicroBatcher(scorer, max_batch_size, max_wait_ms)
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        asyncio.get_running_loop().create_task(self.batcher.run())
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f'[*] Serving on http://{self.host}:{self.port}')
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode().split(' ', 2)
+                    headers = {}
+                    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        name, value = line.decode().split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(f'Invalid content-length {length}.')
+                except ValueError as e:
+                    # the end of the request is unknown, so the connection is not reused
+                    await self._respond(writer, '400 Bad Request', {'error': f'Malformed request: {e}'})
+                    break
+                body = await reader.readexactly(length)
+
+                status, payload = await self._route(method, path, body)
+                await self._respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, payload: dict):
+        response = json.dumps(payload).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(response)}\r\n\r\n'.encode() + response
+        )
+        await writer.drain()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[str, dict]:
+        if method == 'GET' and path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if method != 'POST' or path != '/score':
+            return '404 Not Found', {'error': f'{method} {path} is not served.'}
+        try:
+            records = json.loads(body)
+            if not isinstance(records, dict) or 'base' not in records:
+                raise ValueError('Payload should be an object of records with a base record.')
+            return '200 OK', {'score': await self.batcher.submit(records)}
+        except ValueError as e:
+            return '400 Bad Request', {'error': str(e)}
+        except Exception as e:
+            return '500 Internal Server Error', {'error': str(e)}
+
+
+async def generate_load(
+    host: str, port: int, payloads: List[bytes], n_requests: int, concurrency: int
+) -> Dict[str, float]:
+    """
+    Send n_requests POST /score over concurrency keep-alive connections,
+    cycling through payloads, and measure throughput and latency.
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(n_requests))
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in counter:
+            payload = payloads[i % len(payloads)]
+            start_time = time.perf_counter()
+            writer.write(
+                f'POST /score HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+            )
+            await writer.drain()
+            status = (await reader.readline()).split()[1]
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers['content-length']))
+            latencies.append(time.perf_counter() - start_time)
+            errors += status != b'200'
+        writer.close()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start_time
+    latencies = np.array(latencies) * 1000
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50': float(np.percentile(latencies, 50)),
+        'p99': float(np.percentile(latencies, 99)),
+        'errors': errors,
+    }
+
+
+def _serve_in_thread(server: ScoringServer):
+    started = threading.Event()
+
+    def serve():
+        async def main():
+            await server.start()
+            started.set()
+            await asyncio.Event().wait()
+        asyncio.run(main())
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+
+
+if __name__ == '__main__':
+    # load test against a local server, with and without coalescing
+    type_ = 'train'
+    n_cases = 200
+    n_requests = 2000
+    scorer = OnlineScorer('lgbm_test')
+    case_ids = scorer.score_batch(type_)[KEY_COL[0]].head(n_cases).to_list()
+    payloads = [
+        json.dumps({key: table.to_pylist() for key, table in records.items()}).encode()
+        for records in scorer.raw_records(case_ids, type_).values()
+    ]
+
+    for max_batch_size in [1, 64]:
+        server = ScoringServer(scorer, port=0, max_batch_size=max_batch_size, max_wait_ms=5.0)
+        _serve_in_thread(server)
+        for concurrency in [1, 16, 64]:
+            stats = asyncio.run(
+                generate_load(server.host, server.port, payloads, n_requests, concurrency)
+            )
+            batch_sizes = server.batcher.batch_sizes
+            print(
+                f'[*] max_batch_size={max_batch_size:>3} concurrency={concurrency:>3}: '
+                f'{stats["throughput"]:8.1f} req/s, p50 {stats["p50"]:6.2f} ms, '
+                f'p99 {stats["p99"]:6.2f} ms, mean batch {np.mean(batch_sizes):5.1f}, '
+                f'{stats["errors"]} errors'
+            )
+            batch_sizes.clear()
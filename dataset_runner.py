@@ -1,57 +1,75 @@
 import gc
 import json
+import os
 import time
 import polars as pl
+from typing import Union
 from tqdm import tqdm
 from dataset.feature.feature import *
-from dataset.feature.util import optimize_dataframe 
-
 from dataset.datainfo import RawInfo, RawReader, DATA_PATH
 from dataset.feature.feature import *
-from dataset.feature.util import optimize_dataframe
-from dataset.const import TOPICS
-
-
-topic = 'applprev'
-type_ = 'train'
-# load features from json file
-with open(DATA_PATH / f'feature_definition/{topic}.json', 'r') as f:
-    features = [Feature.from_dict(feature) for feature in json.load(f).values()]
-
-rawinfo = RawInfo()
-data = rawinfo.read_raw(topic, depth=1, reader=RawReader('polars'), type_=type_, stage='prep')
-base = rawinfo.read_raw('base', reader=RawReader('polars'), type_=type_, stage='prep')
-frame = data.join(base.select(['case_id', 'date_decision']), on='case_id', how='inner')
+from dataset.feature.util import DtypePlanStore
+from dataset.feature.feature_loader import FeatureLoader
+from dataset.feature.feature_definer import FEATURE_DEF_PATH
+from dataset.feature.definition_store import load_definitions
+from dataset.feature.feature_builder import ShardedFeatureBuilder
+from dataset.feature.feature_manifest import FeatureManifest
+from dataset.const import TOPICS, KEY_COL
 
 
 class FeatureBuilder:
-    def __init__(self, frame: pl.DataFrame, features: List[Feature], batch_size: int = 500):
+    def __init__(
+        self,
+        frame: Union[pl.DataFrame, pl.LazyFrame],
+        features: List[Feature],
+        batch_size: int = 500,
+        topic: str = 'applprev',
+        type_: str = 'train',
+    ):
         self.frame = frame
+        self.topic = topic
+        self.type_ = type_
         self.features = features
         self.batch_size = batch_size
+        self.dtypes = DtypePlanStore(RawInfo.get_dtype_plan_path(f'{topic}_features', 1), type_)
 
     def execute_query(self, frame, features, batch_size):
         start_time = time.time()
         for i, index in enumerate(tqdm(range(0, len(features), batch_size))):  
-            query = [
-                f'cast({feat.query} as {feat.agg.data_type}) as {feat.name}'
-                for feat in features[index : index + batch_size]
-            ]
-            temp = pl.SQLContext(frame=frame).execute(
-                    f"""
-                    SELECT frame.case_id
-                        , {', '.join(query)}
-                    from frame
-                    group by frame.case_id"""
-                    , eager=True
-                )
-            temp = optimize_dataframe(temp, verbose=True)
+            temp = FeatureLoader.query_expr(
+                frame, features[index : index + batch_size], KEY_COL
+            )
+            temp = self.dtypes.apply(temp)
             temp.write_parquet(
-                DATA_PATH / f'{type_}_feature/{type_}_{topic}_features_{i}.parquet',
+                DATA_PATH / f'{self.type_}_feature/{self.type_}_{self.topic}_features_{i}.parquet',
             )
             del temp
             gc.collect()
         print(f'[*] Elapsed time: {time.time() - start_time:.4f} sec')
 
 
-df = FeatureBuilder().execute_query(frame, features, 5000)
+if __name__ == '__main__':
+    topic = 'applprev'
+    type_ = 'train'
+    n_shards = 32
+    n_workers = os.cpu_count()
+    memory_limit_mb = 8192
+    # load features from the definition store, or the json file
+    features = load_definitions(FEATURE_DEF_PATH, topic)
+
+    rawinfo = RawInfo()
+    # scan lazily so each batch only reads the columns it references
+    data = rawinfo.read_raw(topic, depth=1, reader=RawReader('lazy'), type_=type_, stage='prep')
+    base = rawinfo.read_raw('base', reader=RawReader('lazy'), type_=type_, stage='prep')
+    frame = data.join(base.select(['case_id', 'date_decision']), on='case_id', how='inner')
+
+    # sequential: FeatureBuilder(frame, features).execute_query(frame, features, 5000)
+    builder = ShardedFeatureBuilder(
+        n_shards=n_shards,
+        n_workers=n_workers,
+        memory_limit_mb=memory_limit_mb,
+        dtypes=DtypePlanStore(RawInfo.get_dtype_plan_path(f'{topic}_features', 1), type_),
+    )
+    # only compute features missing from the manifest, drop the ones no longer defined
+    manifest = FeatureManifest(DATA_PATH / f'{type_}_feature', f'{type_}_{topic}_features')
+    manifest.sync(features, builder, frame, KEY_COL, batch_size=5000)
@@ -2,6 +2,7 @@ import os
 from typing import Dict
 from dataset.feature.feature import *
 from dataset.feature.feature_definer import FeatureDefiner, FEATURE_DEF_PATH
+from dataset.feature.definition_store import DEFINITION_SUFFIX
 from dataset import const
 
 period_col: Dict[str, List[str]] = {
@@ -27,5 +28,6 @@ if __name__ == '__main__':
             print(f'[*] Defining features for {topic.name}')
             fd = FeatureDefiner(topic.name, period_cols=period_col.get(topic.name, None))
             fd.define_features()
-            fd.save_features_as_json(FEATURE_DEF_PATH / f'{topic.name}.json')
-            print(f'{topic.name} has {len(fd.features)} features')
+            # normalized store instead of a json of every nested definition
+            fd.save_features(FEATURE_DEF_PATH / f'{topic.name}{DEFINITION_SUFFIX}')
+            print(f'{topic.name} has {len(fd.features)} features, {len(fd.duplicates)} duplicates dropped')
@@ -1,24 +1,24 @@
-import glob
 import json
 import os
-from typing import Dict
-from dataset.feature.feature import *
+from pathlib import Path
+from dataset.feature.definition_store import load_definitions
+from dataset.feature.feature_definer import FeatureDefiner, FEATURE_DEF_PATH
 from dataset import const
 
 path = 'data/feature_selection.json'
 with open(path, 'r') as f:
-    feature_selection = json.load(f)
+    feature_selection = set(json.load(f))
 
-FEATURE_DEF_PATH = 'data/feature_definition'
-new_feature_def = dict()
-for file in glob.glob(f'{FEATURE_DEF_PATH}/*.json'):
-    with open(file, 'r') as f:
-        feature_def = json.load(f)
-    new_feature_def = {
-        feature_name: feature 
-        for feature_name, feature in feature_def.items() 
-        if feature_name in feature_selection}
-
-    file = file.replace('feature_definition', 'feature_definition_new')
-    with open(file, 'w') as f:
-        json.dump(new_feature_def, f)
+NEW_FEATURE_DEF_PATH = Path('data/feature_definition_new')
+os.makedirs(NEW_FEATURE_DEF_PATH, exist_ok=True)
+for topic in const.TOPICS:
+    if topic.depth != 1:
+        continue
+    try:
+        # the store define_runner writes, or a json written before it
+        features = load_definitions(FEATURE_DEF_PATH, topic.name)
+    except FileNotFoundError:
+        continue
+    new_features = [feature for feature in features if feature.name in feature_selection]
+    FeatureDefiner.save_json(new_features, NEW_FEATURE_DEF_PATH / f'{topic.name}.json')
+    print(f'{topic.name}: {len(new_features)} of {len(features)} features kept')